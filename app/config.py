@@ -1,4 +1,7 @@
 # app/config.py
+import os
+from typing import Optional
+
 from dotenv import load_dotenv
 from pydantic import BaseSettings, Field
 
@@ -8,11 +11,66 @@ class Settings(BaseSettings):
   db_url: str = Field(..., env='DATABASE_URL')
   building_connected_username: str = Field(..., env='BUILDING_CONNECTED_USERNAME')
   building_connected_password: str = Field(..., env='BUILDING_CONNECTED_PASSWORD')
+  # max concurrent requests against building connected, and pages of a pipeline partition fetched at once
+  bc_concurrency: int = Field(8, env='BC_CONCURRENCY')
+  bc_prefetch_pages: int = Field(3, env='BC_PREFETCH_PAGES')
+  # bid file downloads: total and per host concurrency, and how often an interrupted download is resumed
+  bc_download_concurrency: int = Field(4, env='BC_DOWNLOAD_CONCURRENCY')
+  bc_downloads_per_host: int = Field(4, env='BC_DOWNLOADS_PER_HOST')
+  bc_download_retries: int = Field(5, env='BC_DOWNLOAD_RETRIES')
   buildflow_username: str = Field(..., env='BUILDFLOW_USERNAME')
   buildflow_password: str = Field(..., env='BUILDFLOW_PASSWORD')
   aws_access_key_id: str = Field(..., env='AWS_ACCESS_KEY_ID')
   aws_secret_access_key: str = Field(..., env='AWS_SECRET_ACCESS_KEY')
   aws_region: str = Field(..., env='AWS_REGION')
   textract_bucket_name: str = Field(..., env='TEXTRACT_BUCKET_NAME')
+  # number of pdf pages rasterized and held in memory at once during image extraction
+  pdf_page_window: int = Field(1, env='PDF_PAGE_WINDOW')
+  # process pool size for image extraction and how many pages each pool task renders
+  pdf_workers: int = Field(os.cpu_count() or 1, env='PDF_WORKERS')
+  pdf_pages_per_task: int = Field(4, env='PDF_PAGES_PER_TASK')
+  # png_md5 hashes the encoded png (the original unique_images key); md5, xxhash and blake3
+  # hash the decoded pixels instead. Hashes from different algorithms never dedupe against each other
+  image_hash_algorithm: str = Field('png_md5', env='IMAGE_HASH_ALGORITHM')
+  # projection (ink profiles + integral image), coarse (projection on a downsampled sheet, refined
+  # at full resolution) or hough (the original HoughLinesP detector)
+  panel_detection_mode: str = Field('projection', env='PANEL_DETECTION_MODE')
+  panel_detection_scale: float = Field(0.25, env='PANEL_DETECTION_SCALE')
+  # pytesseract (a tesseract process per call) or tesserocr (one engine loaded per worker process)
+  ocr_backend: str = Field('pytesseract', env='OCR_BACKEND')
+  # wide pads ocr crops by their own width on every side, tight by ocr_tight_margin pixels.
+  # In tight mode crops can also be rescaled from the 300 dpi render to ocr_target_dpi
+  ocr_padding_mode: str = Field('wide', env='OCR_PADDING_MODE')
+  ocr_tight_margin: int = Field(20, env='OCR_TIGHT_MARGIN')
+  ocr_target_dpi: Optional[int] = Field(None, env='OCR_TARGET_DPI')
+  # annotate_drawings: worker processes, images dispatched but not yet written, and annotations per insert
+  annotate_workers: int = Field(os.cpu_count() or 1, env='ANNOTATE_WORKERS')
+  annotate_max_in_flight: int = Field(64, env='ANNOTATE_MAX_IN_FLIGHT')
+  annotate_batch_size: int = Field(100, env='ANNOTATE_BATCH_SIZE')
+  # run_drawing_inference: images per model call and batches decoded ahead of the model
+  inference_batch_size: int = Field(4, env='INFERENCE_BATCH_SIZE')
+  inference_prefetch_batches: int = Field(2, env='INFERENCE_PREFETCH_BATCHES')
+  # flag_drawings: images per classifier call
+  classifier_batch_size: int = Field(32, env='CLASSIFIER_BATCH_SIZE')
+  # memory mapped 512x512 grayscale tensors shared by classifier training, tuning and scoring
+  tensor_cache_path: str = Field('/Users/harish/data/bidboard_models/tensor_cache', env='TENSOR_CACHE_PATH')
+  # local keeps files under storage_path; s3 keeps them in storage_bucket (storage_endpoint_url points
+  # it at minio or another s3 compatible server) and uses storage_path as a local read cache
+  storage_backend: str = Field('local', env='STORAGE_BACKEND')
+  storage_path: str = Field('/Users/harish/data/bidboard_storage', env='STORAGE_PATH')
+  storage_bucket: Optional[str] = Field(None, env='STORAGE_BUCKET')
+  storage_endpoint_url: Optional[str] = Field(None, env='STORAGE_ENDPOINT_URL')
+  # pipeline task queue: how long a claimed task is held before another worker may take it over,
+  # how often it's tried, and the base delay before a failed task is retried (doubled per attempt)
+  task_lease_seconds: int = Field(900, env='TASK_LEASE_SECONDS')
+  task_max_attempts: int = Field(3, env='TASK_MAX_ATTEMPTS')
+  task_retry_delay_seconds: int = Field(60, env='TASK_RETRY_DELAY_SECONDS')
+  # run_pipeline: items buffered between stages, the classifier probability an image needs to go on
+  # to sheet number detection, and concurrent textract calls when the textract stage is enabled
+  pipeline_queue_size: int = Field(256, env='PIPELINE_QUEUE_SIZE')
+  pipeline_drawing_threshold: float = Field(0.5, env='PIPELINE_DRAWING_THRESHOLD')
+  pipeline_textract_concurrency: int = Field(1, env='PIPELINE_TEXTRACT_CONCURRENCY')
+  # pytorch, onnx, openvino or openvino_int8; export with export_sheet_drawing_number_identifier first
+  detector_backend: str = Field('pytorch', env='DETECTOR_BACKEND')
 
 settings = Settings()
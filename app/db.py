@@ -1,7 +1,8 @@
 # app/db.py
+import collections
 import datetime
 from enum import Enum
-from typing import Optional, AsyncGenerator, Dict, Any
+from typing import Optional, AsyncGenerator, Dict, Any, List
 import uuid
 
 import databases
@@ -12,6 +13,8 @@ from .config import settings
 
 database = databases.Database(settings.db_url)
 metadata = sqlalchemy.MetaData()
+# namedtuple classes built by BaseModel.row_type, one per model and column list
+row_types = {}
 
 class BaseMeta(ormar.ModelMeta):
   metadata = metadata
@@ -32,22 +35,108 @@ class BaseModel(ormar.Model):
       target.updated_at = datetime.datetime.utcnow()
 
   @classmethod
-  async def process_in_batches(cls, batch_size: int = 100, **filters: Dict[str, Any]) -> AsyncGenerator["BaseModel", None]:
-    last_created_at = None
+  def _batch_query(cls, fields: Optional[List[str]] = None, **filters: Dict[str, Any]):
+    query = cls.objects.filter(**filters)
+    if fields is not None:
+      # the keyset columns are always loaded
+      query = query.fields(list(dict.fromkeys(['id', 'created_at'] + list(fields))))
+    return query.order_by(["created_at", "id"])
+
+  @classmethod
+  async def iterate_batches(cls, batch_size: int = 100, fields: Optional[List[str]] = None, **filters: Dict[str, Any]) -> AsyncGenerator[List["BaseModel"], None]:
+    # pages on (created_at, id) rather than created_at alone, since bulk inserts give whole
+    # batches of rows the same created_at and those would otherwise be skipped
+    last = None
     while True:
-      query = cls.objects.filter(**filters)
-      if last_created_at is not None:
-        query = query.filter(created_at__gt=last_created_at)
-      query = query.order_by("created_at").limit(batch_size)
+      query = cls._batch_query(fields, **filters)
+      if last is not None:
+        query = query.filter(ormar.or_(
+          ormar.and_(created_at=last.created_at, id__gt=last.id),
+          created_at__gt=last.created_at
+        ))
 
-      batch = await query.all()
+      batch = await query.limit(batch_size).all()
       if not batch:
         break
 
+      yield batch
+
+      last = batch[-1]
+
+  @classmethod
+  async def process_in_batches(cls, batch_size: int = 100, fields: Optional[List[str]] = None, **filters: Dict[str, Any]) -> AsyncGenerator["BaseModel", None]:
+    async for batch in cls.iterate_batches(batch_size, fields, **filters):
       for item in batch:
         yield item
 
-      last_created_at = batch[-1].created_at
+  @classmethod
+  async def iterate_with_cursor(cls, fields: Optional[List[str]] = None, **filters: Dict[str, Any]) -> AsyncGenerator["BaseModel", None]:
+    # a single query streamed through a server side cursor. It keeps a transaction open until the
+    # scan finishes, so prefer process_in_batches when each row takes long to process
+    async for item in cls._batch_query(fields, **filters).iterate():
+      yield item
+
+  @classmethod
+  def row_type(cls, columns: List[str]):
+    # namedtuples are slotted and skip pydantic validation entirely, which is what makes
+    # scanning millions of rows affordable
+    key = (cls.Meta.tablename, tuple(columns))
+    if key not in row_types:
+      row_types[key] = collections.namedtuple('%sRow' % cls.__name__, columns)
+    return row_types[key]
+
+  @classmethod
+  def _rows_query(cls, columns: List[str], where=None, **filters: Dict[str, Any]):
+    # filters are equality checks, or column__isnull=True/False
+    table = cls.Meta.table
+    clauses = [] if where is None else [where]
+    for name, value in filters.items():
+      if name.endswith('__isnull'):
+        column = table.c[name[:-len('__isnull')]]
+        clauses.append(column.is_(None) if value else column.isnot(None))
+      else:
+        clauses.append(table.c[name] == value)
+    query = sqlalchemy.select([table.c[column] for column in columns])
+    if len(clauses) > 0:
+      query = query.where(sqlalchemy.and_(*clauses))
+    return query
+
+  @classmethod
+  async def fetch_rows(cls, columns: List[str], where=None, **filters: Dict[str, Any]) -> List[Any]:
+    row_type = cls.row_type(columns)
+    rows = await cls.Meta.database.fetch_all(cls._rows_query(columns, where, **filters))
+    return [row_type(*[row[column] for column in columns]) for row in rows]
+
+  @classmethod
+  async def iterate_row_batches(cls, columns: List[str], batch_size: int = 1000, where=None, **filters: Dict[str, Any]) -> AsyncGenerator[List[Any], None]:
+    # same (created_at, id) keyset as iterate_batches, but only the requested columns come back
+    table = cls.Meta.table
+    row_type = cls.row_type(columns)
+    keyset_columns = [column for column in ['created_at', 'id'] if column not in columns]
+    last = None
+    while True:
+      query = cls._rows_query(list(columns) + keyset_columns, where, **filters)
+      if last is not None:
+        # bound through the column types, an untyped uuid can't be compared to the hex id column
+        query = query.where(sqlalchemy.tuple_(table.c.created_at, table.c.id) > sqlalchemy.tuple_(
+          sqlalchemy.literal(last[0], table.c.created_at.type),
+          sqlalchemy.literal(last[1], table.c.id.type)
+        ))
+      query = query.order_by(table.c.created_at, table.c.id).limit(batch_size)
+
+      rows = await cls.Meta.database.fetch_all(query)
+      if not rows:
+        break
+
+      yield [row_type(*[row[column] for column in columns]) for row in rows]
+
+      last = (rows[-1]['created_at'], rows[-1]['id'])
+
+  @classmethod
+  async def iterate_rows(cls, columns: List[str], batch_size: int = 1000, where=None, **filters: Dict[str, Any]) -> AsyncGenerator[Any, None]:
+    async for batch in cls.iterate_row_batches(columns, batch_size, where, **filters):
+      for row in batch:
+        yield row
 
 class Company(BaseModel):
   class Meta(BaseMeta):
@@ -87,6 +176,17 @@ class BCBid(BaseModel):
   status: int = ormar.Integer(nullable=False, choices=list(BCBidStatus))
   is_archived: bool = ormar.Boolean(nullable=False)
   data: dict = ormar.JSON(nullable=False)
+  date_modified: datetime.datetime = ormar.DateTime(nullable=True)
+  files_hash: str = ormar.String(nullable=True, max_length=64)
+
+class BCSyncWatermark(BaseModel):
+  class Meta(BaseMeta):
+    tablename = "bc_sync_watermarks"
+    constraints = [
+      sqlalchemy.UniqueConstraint('company_id')
+    ]
+  company_id: Company = ormar.ForeignKey(Company, nullable=False)
+  date_invited: datetime.datetime = ormar.DateTime(nullable=True)
 
 class BCBidFileSystemType(Enum):
   FOLDER = 0
@@ -149,3 +249,38 @@ class UniqueImageAnnotation(BaseModel):
   annotation_source: int = ormar.Integer(nullable=True, choices=list(AnnotationSource))
   refined: bool = ormar.Boolean(nullable=True)
   confidence: float = ormar.Float(nullable=True)
+
+class ModelPrediction(BaseModel):
+  class Meta(BaseMeta):
+    tablename = "model_predictions"
+    constraints = [
+      sqlalchemy.UniqueConstraint('md5_hash', 'model_id', 'model_version', 'preprocessing_version')
+    ]
+  md5_hash: str = ormar.String(nullable=False, max_length=100)
+  model_id: str = ormar.String(nullable=False, max_length=100)
+  model_version: str = ormar.String(nullable=False, max_length=64)
+  preprocessing_version: str = ormar.String(nullable=False, max_length=32)
+  prediction: dict = ormar.JSON(nullable=False)
+
+class PipelineTaskStatus(Enum):
+  PENDING = 0
+  RUNNING = 1
+  DONE = 2
+  FAILED = 3
+
+class PipelineTask(BaseModel):
+  class Meta(BaseMeta):
+    tablename = "pipeline_tasks"
+    constraints = [
+      sqlalchemy.UniqueConstraint('stage', 'subject_id'),
+      ormar.IndexColumns('stage', 'status', 'available_at', name='ix_pipeline_tasks_claim')
+    ]
+  stage: str = ormar.String(nullable=False, max_length=50)
+  # the id of the row the stage works on, e.g. a bc_bid_file or a unique_image
+  subject_id: uuid.UUID = ormar.UUID(nullable=False)
+  status: int = ormar.Integer(nullable=False, choices=list(PipelineTaskStatus), default=PipelineTaskStatus.PENDING.value)
+  attempts: int = ormar.Integer(nullable=False, default=0)
+  available_at: datetime.datetime = ormar.DateTime(nullable=False, default=datetime.datetime.utcnow)
+  lease_expires_at: datetime.datetime = ormar.DateTime(nullable=True)
+  worker_id: str = ormar.String(nullable=True, max_length=100)
+  last_error: str = ormar.Text(nullable=True)
@@ -1,17 +1,84 @@
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy
 
 from app import db
-from app.services.bid_file_annotation_service import BidFileAnnotationService
+from app.config import settings
+from app.services.bid_file_annotation_service import BidFileAnnotationService, init_annotation_worker, detect_page_number_in_worker
+from app.services.task_queue_service import TaskQueueService
+
+STAGE = 'annotate_drawings'
+
+async def enqueue_unique_images(queue, retry_failed=False):
+  unique_images = db.UniqueImage.Meta.table
+  annotations = db.UniqueImageAnnotation.Meta.table
+  rows = await db.database.fetch_all(
+    sqlalchemy.select([unique_images.c.id]).where(sqlalchemy.and_(
+      unique_images.c.has_architectural_page_number == True,
+      ~unique_images.c.id.in_(sqlalchemy.select([annotations.c.unique_image_id]))
+    ))
+  )
+  await queue.enqueue([row['id'] for row in rows], retry_failed=retry_failed)
+
+async def annotate_drawings(workers=None, max_in_flight=None, batch_size=None, enqueue=True, retry_failed=False):
+  if workers is None:
+    workers = settings.annotate_workers
+  if max_in_flight is None:
+    max_in_flight = settings.annotate_max_in_flight
+  if batch_size is None:
+    batch_size = settings.annotate_batch_size
 
-async def annotate_drawings():
   async with db.database:
     bfas = BidFileAnnotationService(db.database)
-    for bid_file_image in await db.UniqueImage.objects.filter(has_architectural_page_number=True).all():
-      await bfas.annotate_page_number(bid_file_image)
+    queue = TaskQueueService(db.database, STAGE)
+    if enqueue:
+      await enqueue_unique_images(queue, retry_failed)
+
+    loop = asyncio.get_running_loop()
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def detect(unique_image):
+      async with in_flight:
+        return await loop.run_in_executor(executor, detect_page_number_in_worker, unique_image.id, unique_image.local_filename)
+
+    async def annotate(unique_image_ids):
+      # a claimed batch is written with one insert, and only completed once it's written. Images
+      # that can't be read or detected on are failed on their own, the rest of the batch completes
+      unique_images = await db.UniqueImage.fetch_rows(
+        ['id', 'local_filename'],
+        where=db.UniqueImage.Meta.table.c.id.in_(unique_image_ids)
+      )
+      failures = {
+        unique_image.id: 'no local_filename'
+        for unique_image in unique_images if unique_image.local_filename is None
+      }
+      unique_images = [unique_image for unique_image in unique_images if unique_image.local_filename is not None]
+      results = await asyncio.gather(*[detect(unique_image) for unique_image in unique_images], return_exceptions=True)
+      annotations = []
+      for unique_image, result in zip(unique_images, results):
+        if isinstance(result, Exception):
+          failures[unique_image.id] = repr(result)
+          continue
+        unique_image_id, page_number_text, page_number_coordinates = result
+        if page_number_text:
+          annotations.append(bfas.build_page_number_annotation(unique_image_id, page_number_text, page_number_coordinates))
+      if len(annotations) > 0:
+        await db.UniqueImageAnnotation.objects.bulk_create(annotations)
+      print("Annotated %s of %s images, %s failed" % (len(annotations), len(unique_images), len(failures)))
+      return failures
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_annotation_worker) as executor:
+      # two batches at a time, so the pool keeps working while the previous batch is written
+      annotated = await queue.work(annotate, batch_size=batch_size, concurrency=2)
+    print("Processed %s images" % annotated)
 
 if __name__ == '__main__':
   import sys
 
-  asyncio.run(annotate_drawings())
+  asyncio.run(annotate_drawings(
+    enqueue='--worker' not in sys.argv,
+    retry_failed='--retry-failed' in sys.argv
+  ))
 
   sys.exit()
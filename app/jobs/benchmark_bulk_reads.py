@@ -0,0 +1,84 @@
+import asyncio
+import datetime
+import time
+import tracemalloc
+import uuid
+
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+
+COLUMNS = ['id', 'md5_hash', 'local_filename', 'architectural_page_number_probability']
+# synthetic rows are tagged so they can be told apart from real images and cleaned up
+SEED_PREFIX = 'benchmark-'
+
+async def seed_unique_images(count, batch_size=10000):
+  unique_images = db.UniqueImage.Meta.table
+  now = datetime.datetime.utcnow()
+  for i in range(0, count, batch_size):
+    await db.database.execute(
+      insert(unique_images).values([
+        {
+          'id': uuid.uuid4(),
+          'created_at': now,
+          'md5_hash': '%s%032d' % (SEED_PREFIX, n),
+          'local_filename': 'unique_images/%s%032d.png' % (SEED_PREFIX, n),
+          'architectural_page_number_probability': 0.5
+        }
+        for n in range(i, min(i + batch_size, count))
+      ]).on_conflict_do_nothing(index_elements=['md5_hash'])
+    )
+    print("Seeded %s of %s" % (min(i + batch_size, count), count))
+
+async def delete_seeded_unique_images():
+  unique_images = db.UniqueImage.Meta.table
+  await db.database.execute(unique_images.delete().where(unique_images.c.md5_hash.startswith(SEED_PREFIX)))
+
+async def read_models():
+  return [unique_image async for unique_image in db.UniqueImage.process_in_batches(1000)]
+
+async def read_projected_models():
+  return [unique_image async for unique_image in db.UniqueImage.process_in_batches(1000, fields=COLUMNS[1:])]
+
+async def read_rows():
+  return [unique_image async for unique_image in db.UniqueImage.iterate_rows(COLUMNS, 1000)]
+
+async def benchmark(name, read):
+  # rows are kept until the end, the way a job holding a batch (or a training set) would
+  tracemalloc.start()
+  start = time.perf_counter()
+  rows = await read()
+  elapsed = time.perf_counter() - start
+  retained, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  print("%-20s %10s rows %8.1fs %10.0f rows/s %9.0f mb retained %9.0f mb peak %6.0f bytes/row" % (
+    name,
+    len(rows),
+    elapsed,
+    len(rows) / elapsed if elapsed > 0 else 0,
+    retained / 2**20,
+    peak / 2**20,
+    retained / len(rows) if len(rows) > 0 else 0
+  ))
+
+async def benchmark_bulk_reads(seed=0, cleanup=False):
+  async with db.database:
+    if seed > 0:
+      await seed_unique_images(seed)
+    try:
+      await benchmark('ormar models', read_models)
+      await benchmark('ormar fields=', read_projected_models)
+      await benchmark('projected rows', read_rows)
+    finally:
+      if cleanup:
+        await delete_seeded_unique_images()
+
+
+if __name__ == '__main__':
+  import sys
+
+  # --seed 1000000 to benchmark against a million synthetic rows, --cleanup to remove them afterwards
+  seed = int(sys.argv[sys.argv.index('--seed') + 1]) if '--seed' in sys.argv else 0
+  asyncio.run(benchmark_bulk_reads(seed, '--cleanup' in sys.argv))
+
+  sys.exit()
@@ -0,0 +1,61 @@
+import json
+import subprocess
+import sys
+
+# modules a headless stage should be able to import without dragging these in
+HEAVY_MODULES = ['PyQt5', 'tensorflow', 'ultralytics', 'torch', 'boto3', 'pdf2image', 'pytesseract']
+
+MODULES = [
+  'app.db',
+  'app.storage',
+  'app.services.ocr_service',
+  'app.services.bid_file_annotation_service',
+  'app.services.building_connected_data_service',
+  'app.services.textract_service',
+  'app.services.drawing_detector_service',
+  'app.jobs.annotate_drawings',
+  'app.jobs.extract_images',
+  'app.jobs.run_drawing_inference',
+  'app.jobs.train_sheet_drawing_number_identifier',
+]
+
+# runs in a fresh interpreter per module so nothing is already cached in sys.modules
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+  max_rss = max_rss / 1024
+print(json.dumps({
+  'seconds': elapsed,
+  'max_rss_mb': max_rss / 1024,
+  'heavy': [name for name in %r if name in sys.modules]
+}))
+"""
+
+def benchmark_import(module, repeat=3):
+  runs = []
+  for _ in range(repeat):
+    result = subprocess.run([sys.executable, '-c', PROBE % (module, HEAVY_MODULES)], capture_output=True, text=True)
+    if result.returncode != 0:
+      return None, result.stderr.strip().splitlines()[-1]
+    runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+  # the fastest run is the least disturbed by disk cache and scheduling noise
+  return min(runs, key=lambda run: run['seconds']), None
+
+def benchmark_imports(modules):
+  print("%-50s %8s %9s  %s" % ('module', 'seconds', 'rss (mb)', 'heavy modules loaded'))
+  for module in modules:
+    run, error = benchmark_import(module)
+    if run is None:
+      print("%-50s failed: %s" % (module, error))
+      continue
+    print("%-50s %8.2f %9.0f  %s" % (module, run['seconds'], run['max_rss_mb'], ', '.join(run['heavy']) or '-'))
+
+
+if __name__ == '__main__':
+  benchmark_imports(sys.argv[1:] or MODULES)
+
+  sys.exit()
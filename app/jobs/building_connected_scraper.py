@@ -17,15 +17,17 @@ async def parse_bids(company):
     bcds = BuildingConnectedDataService(db.database, company)
     await bcds.parse_bids()
 
-async def sync_bids(company):
+async def sync_bids(company, incremental=False):
+  # incremental syncs stop paging at the date_invited watermark, so a bid whose workflowState or
+  # isArchived changes after it was first synced is only picked up again by a full sync
   async with db.database:
     bcds = BuildingConnectedDataService(db.database, company)
-    await bcds.sync_bids()
+    await bcds.sync_bids(incremental=incremental)
 
 if __name__ == '__main__':
   import sys
 
   company = asyncio.run(get_or_create_company('Tristate Plumbing'))
-  asyncio.run(sync_bids(company))
+  asyncio.run(sync_bids(company, incremental='--incremental' in sys.argv))
 
   sys.exit()
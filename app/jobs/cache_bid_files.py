@@ -8,13 +8,13 @@ async def cache_bids():
     # right now its only tristate
     company = await db.Company.objects.get(name='Tristate Plumbing')
     bcds = BuildingConnectedDataService(db.database, company)
-    bcds.init_session()
-    i = 0
-    for bid_file in await db.BCBidFile.objects.all():
-      await bcds.cache_bid_file(bid_file)
-      i += 1
-      if i % 10 == 0:
-        print("Cached up to %s" % i)
+    await bcds.init_session()
+    cached = 0
+    async for bid_files in db.BCBidFile.iterate_batches(100, local_filename__isnull=True):
+      await bcds.cache_bid_files(bid_files)
+      cached += len(bid_files)
+      print("Cached up to %s" % cached)
+    await bcds.close_session()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+import asyncio
+import datetime
+import uuid
+
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.jobs.train_drawing_detector import save_drawing_probabilities
+
+# synthetic rows, all with the same created_at so paging has to fall back on the id
+SEED_PREFIX = 'check-bulk-reads-'
+
+async def check_bulk_reads(count=25, batch_size=10):
+  # runs iterate_row_batches past its first page and save_drawing_probabilities against the real
+  # database, inside a transaction that is rolled back. Returns a list of failures
+  failures = []
+  unique_images = db.UniqueImage.Meta.table
+  async with db.database:
+    transaction = await db.database.transaction()
+    try:
+      now = datetime.datetime.utcnow()
+      seeded_ids = set(uuid.uuid4() for _ in range(count))
+      await db.database.execute(
+        insert(unique_images).values([
+          {
+            'id': unique_image_id,
+            'created_at': now,
+            'md5_hash': '%s%s' % (SEED_PREFIX, unique_image_id.hex),
+            'architectural_page_number_probability': None
+          }
+          for unique_image_id in seeded_ids
+        ])
+      )
+      seeded = unique_images.c.md5_hash.startswith(SEED_PREFIX)
+
+      pages = []
+      async for batch in db.UniqueImage.iterate_row_batches(['id', 'md5_hash'], batch_size, where=seeded):
+        pages.append(batch)
+      read_ids = [row.id for batch in pages for row in batch]
+      expected_pages = (count + batch_size - 1) // batch_size
+      if len(pages) != expected_pages:
+        failures.append("iterate_row_batches returned %s pages, expected %s" % (len(pages), expected_pages))
+      if len(read_ids) != len(set(read_ids)) or set(read_ids) != seeded_ids:
+        failures.append("iterate_row_batches returned %s rows (%s distinct), expected %s" % (len(read_ids), len(set(read_ids)), count))
+
+      probabilities = {unique_image_id: i / count for i, unique_image_id in enumerate(sorted(seeded_ids))}
+      await save_drawing_probabilities(probabilities, chunk_size=batch_size)
+      for row in await db.UniqueImage.fetch_rows(['id', 'architectural_page_number_probability'], where=seeded):
+        if row.architectural_page_number_probability is None or \
+          abs(row.architectural_page_number_probability - probabilities[row.id]) > 1e-9:
+          failures.append("%s has probability %s, expected %s" % (row.id, row.architectural_page_number_probability, probabilities[row.id]))
+    finally:
+      await transaction.rollback()
+  return failures
+
+
+if __name__ == '__main__':
+  import sys
+
+  failures = asyncio.run(check_bulk_reads())
+  for failure in failures:
+    print(failure)
+  print("bulk reads %s" % ('failed' if len(failures) > 0 else 'ok'))
+
+  sys.exit(1 if len(failures) > 0 else 0)
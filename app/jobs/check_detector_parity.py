@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import cv2
+import numpy as np
+
+from app import db
+from app.storage import resolve
+from app.services.drawing_detector_service import DrawingDetectorService
+
+REFERENCE_BACKEND = 'pytorch'
+
+def iou(box_a, box_b):
+  x1 = max(box_a[0], box_b[0])
+  y1 = max(box_a[1], box_b[1])
+  x2 = min(box_a[2], box_b[2])
+  y2 = min(box_a[3], box_b[3])
+  intersection = max(0, x2 - x1) * max(0, y2 - y1)
+  union = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1]) + (box_b[2] - box_b[0]) * (box_b[3] - box_b[1]) - intersection
+  return intersection / union if union > 0 else 0
+
+async def check_detector_parity(backend, limit=200, iou_threshold=0.5):
+  async with db.database:
+    unique_images = await db.UniqueImage.objects.filter(has_architectural_page_number=True).limit(limit).all()
+
+  reference = DrawingDetectorService(REFERENCE_BACKEND).load()
+  candidate = DrawingDetectorService(backend).load()
+  timings = {REFERENCE_BACKEND: [], backend: []}
+  reference_boxes = 0
+  matched_boxes = 0
+  matched_ious = []
+  confidence_deltas = []
+  top_box_agreements = 0
+  evaluated = 0
+  for unique_image in unique_images:
+    image = cv2.imread(resolve(unique_image.local_filename), cv2.IMREAD_COLOR)
+    if image is None:
+      continue
+    evaluated += 1
+    detections = {}
+    for name, detector in [(REFERENCE_BACKEND, reference), (backend, candidate)]:
+      start = time.perf_counter()
+      detections[name] = detector.detect([image])[0]
+      timings[name].append(time.perf_counter() - start)
+
+    expected = sorted(detections[REFERENCE_BACKEND], key=lambda box: -box[4])
+    actual = sorted(detections[backend], key=lambda box: -box[4])
+    if (len(expected) == 0 and len(actual) == 0) or \
+      (len(expected) > 0 and len(actual) > 0 and iou(expected[0], actual[0]) >= iou_threshold):
+      top_box_agreements += 1
+    # greedy one to one matching, highest confidence first
+    unmatched = list(actual)
+    for box in expected:
+      reference_boxes += 1
+      if len(unmatched) == 0:
+        continue
+      best = max(unmatched, key=lambda other: iou(box, other))
+      if iou(box, best) >= iou_threshold:
+        matched_boxes += 1
+        matched_ious.append(iou(box, best))
+        confidence_deltas.append(abs(box[4] - best[4]))
+        unmatched.remove(best)
+
+  print("compared %s against %s on %s images" % (backend, REFERENCE_BACKEND, evaluated))
+  print("top box agreement: %s/%s" % (top_box_agreements, evaluated))
+  print("box recall vs %s: %s/%s" % (REFERENCE_BACKEND, matched_boxes, reference_boxes))
+  if len(matched_ious) > 0:
+    print("mean matched iou %.4f, mean confidence delta %.4f" % (np.mean(matched_ious), np.mean(confidence_deltas)))
+  for name, values in timings.items():
+    if len(values) > 0:
+      print("%s: mean %.3fs per image" % (name, np.mean(values)))
+
+
+if __name__ == '__main__':
+  import sys
+
+  asyncio.run(check_detector_parity(sys.argv[1] if len(sys.argv) > 1 else 'onnx'))
+
+  sys.exit()
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import cv2
+import numpy as np
+
+from app import db
+from app.storage import resolve
+from app.services.bid_file_annotation_service import BidFileAnnotationService
+
+PADDING_MODES = ['wide', 'tight']
+
+def boxes_overlap(coordinates, annotation):
+  if coordinates is None:
+    return False
+  return coordinates['x1'] < annotation.page_number_x2 and coordinates['x2'] > annotation.page_number_x1 and \
+    coordinates['y1'] < annotation.page_number_y2 and coordinates['y2'] > annotation.page_number_y1
+
+async def compare_ocr_padding(limit=200):
+  async with db.database:
+    bfas = BidFileAnnotationService(db.database)
+    annotations = await db.UniqueImageAnnotation.objects.select_related('unique_image_id').filter(
+      valid=True,
+      page_number__isnull=False
+    ).limit(limit).all()
+
+  timings = {mode: [] for mode in PADDING_MODES}
+  correct_text = {mode: 0 for mode in PADDING_MODES}
+  correct_location = {mode: 0 for mode in PADDING_MODES}
+  evaluated = 0
+  for annotation in annotations:
+    cv2_image = cv2.imread(resolve(annotation.unique_image_id.local_filename), cv2.IMREAD_COLOR)
+    panels = bfas.identify_panels(cv2_image)
+    if len(panels) < 2:
+      continue
+    evaluated += 1
+    for mode in PADDING_MODES:
+      start = time.perf_counter()
+      page_number_text, page_number_coordinates = bfas.identify_page_number_from_sidepanel(cv2_image, panels[-1], padding_mode=mode)
+      timings[mode].append(time.perf_counter() - start)
+      if page_number_text is not None and page_number_text.strip() == annotation.page_number.strip():
+        correct_text[mode] += 1
+      if boxes_overlap(page_number_coordinates, annotation):
+        correct_location[mode] += 1
+
+  print("evaluated %s labeled sheets with detectable sidepanels" % evaluated)
+  for mode in PADDING_MODES:
+    if evaluated == 0:
+      break
+    print("%s: text accuracy %.3f, location accuracy %.3f, mean %.3fs, p95 %.3fs per sidepanel" % (
+      mode,
+      correct_text[mode] / evaluated,
+      correct_location[mode] / evaluated,
+      np.mean(timings[mode]),
+      np.percentile(timings[mode], 95)
+    ))
+
+
+if __name__ == '__main__':
+  import sys
+
+  asyncio.run(compare_ocr_padding())
+
+  sys.exit()
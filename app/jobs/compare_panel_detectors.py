@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+import cv2
+import numpy as np
+
+from app import db
+from app.storage import resolve
+from app.services.bid_file_annotation_service import BidFileAnnotationService
+
+MODES = ['hough', 'projection', 'coarse']
+# (candidate, reference) pairs; coarse is checked against both full resolution detectors
+COMPARISONS = [('projection', 'hough'), ('coarse', 'hough'), ('coarse', 'projection')]
+
+def sidepanels_agree(baseline_panels, candidate_panels, width, height, tolerance=0.01):
+  # we only ever use the rightmost panel, so that's what has to line up
+  if len(baseline_panels) < 2 or len(candidate_panels) < 2:
+    return (len(baseline_panels) < 2) == (len(candidate_panels) < 2)
+  baseline = baseline_panels[-1]
+  candidate = candidate_panels[-1]
+  return abs(baseline['x1'] - candidate['x1']) <= width * tolerance and \
+    abs(baseline['x2'] - candidate['x2']) <= width * tolerance and \
+    abs(baseline['y1'] - candidate['y1']) <= height * tolerance and \
+    abs(baseline['y2'] - candidate['y2']) <= height * tolerance
+
+async def compare_panel_detectors(limit=100):
+  async with db.database:
+    bfas = BidFileAnnotationService(db.database)
+    unique_images = await db.UniqueImage.objects.filter(has_architectural_page_number=True).limit(limit).all()
+
+  timings = {mode: [] for mode in MODES}
+  agreements = {comparison: 0 for comparison in COMPARISONS}
+  for unique_image in unique_images:
+    cv2_image = cv2.imread(resolve(unique_image.local_filename), cv2.IMREAD_COLOR)
+    height, width = cv2_image.shape[:2]
+    panels = {}
+    for mode in MODES:
+      start = time.perf_counter()
+      panels[mode] = bfas.identify_panels(cv2_image, mode=mode)
+      timings[mode].append(time.perf_counter() - start)
+    for candidate, reference in COMPARISONS:
+      if sidepanels_agree(panels[reference], panels[candidate], width, height):
+        agreements[(candidate, reference)] += 1
+      else:
+        print("%s disagrees with %s on %s: %s vs %s" % (candidate, reference, unique_image.local_filename, panels[candidate][-1:], panels[reference][-1:]))
+
+  for mode in MODES:
+    print("%s: mean %.3fs, p50 %.3fs, p95 %.3fs per sheet" % (
+      mode,
+      np.mean(timings[mode]),
+      np.percentile(timings[mode], 50),
+      np.percentile(timings[mode], 95)
+    ))
+  for candidate, reference in COMPARISONS:
+    print("%s agrees with %s on %s/%s sheets" % (candidate, reference, agreements[(candidate, reference)], len(unique_images)))
+
+
+if __name__ == '__main__':
+  import sys
+
+  asyncio.run(compare_panel_detectors())
+
+  sys.exit()
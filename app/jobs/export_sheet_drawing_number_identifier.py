@@ -0,0 +1,16 @@
+import asyncio
+
+from app.services.drawing_detector_service import DrawingDetectorService
+
+
+async def export_model(backend):
+  exported_path = DrawingDetectorService(backend).export()
+  print("Exported %s model to %s" % (backend, exported_path))
+
+
+if __name__ == '__main__':
+  import sys
+
+  asyncio.run(export_model(sys.argv[1] if len(sys.argv) > 1 else 'onnx'))
+
+  sys.exit()
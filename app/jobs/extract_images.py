@@ -1,25 +1,59 @@
 import asyncio
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy
 
 from app import db
+from app.config import settings
 from app.services.bid_file_annotation_service import BidFileAnnotationService
+from app.services.task_queue_service import TaskQueueService
+
+STAGE = 'extract_images'
+SKIPPED_BID_FILE_IDS = [uuid.UUID('05b90232b228-4b95-97a1-8bc6b12c660e')]
+
+async def enqueue_bid_files(queue, retry_failed=False):
+  bid_files = db.BCBidFile.Meta.table
+  rows = await db.database.fetch_all(
+    sqlalchemy.select([bid_files.c.id]).where(sqlalchemy.and_(
+      bid_files.c.mime_type == 'application/pdf',
+      bid_files.c.images_extracted == False
+    ))
+  )
+  await queue.enqueue([row['id'] for row in rows if row['id'] not in SKIPPED_BID_FILE_IDS], retry_failed=retry_failed)
 
-async def extract_bid_images():
+async def extract_bid_images(workers=None, enqueue=True, retry_failed=False):
+  if workers is None:
+    workers = settings.pdf_workers
   async with db.database:
     bfas = BidFileAnnotationService(db.database)
-    i = 0
-    for bid_file in await db.BCBidFile.objects.filter(mime_type='application/pdf', images_extracted=False).all():
-      if bid_file.id == uuid.UUID('05b90232b228-4b95-97a1-8bc6b12c660e'):
-        continue
-      await bfas.extract_images(bid_file)
-      i += 1
-      if i % 10 == 0:
-        print("Extracted up to %s" % i)
+    queue = TaskQueueService(db.database, STAGE)
+    # enqueueing is idempotent, so extra workers can skip it with --worker
+    if enqueue:
+      await enqueue_bid_files(queue, retry_failed)
+
+    async def extract(bid_file_ids):
+      # files that couldn't be extracted (not downloaded, unreadable pdf) are failed rather than
+      # completed, so they're retried and can be queued again with --retry-failed
+      failures = {}
+      for bid_file in await db.BCBidFile.objects.filter(id__in=bid_file_ids).all():
+        if await bfas.extract_images_in_pool(bid_file, executor) is None and not bid_file.images_extracted:
+          failures[bid_file.id] = 'images not extracted'
+      return failures
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      # keep a couple of files per worker in flight so the pool never runs dry
+      # while pages from a finished file are being written back
+      extracted = await queue.work(extract, concurrency=workers * 2)
+    print("Extracted %s bid files" % extracted)
 
 
 if __name__ == '__main__':
   import sys
 
-  asyncio.run(extract_bid_images())
+  asyncio.run(extract_bid_images(
+    enqueue='--worker' not in sys.argv,
+    retry_failed='--retry-failed' in sys.argv
+  ))
 
   sys.exit()
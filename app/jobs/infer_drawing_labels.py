@@ -1,5 +1,9 @@
 import asyncio
 
+from app import db
+from app.storage import resolve
+
+import tensorflow as tf
 from tensorflow.keras.models import load_model
 
 
@@ -20,7 +24,7 @@ async def flag_drawings():
   print(model.input_shape)
   async with db.database:
     for bid_file_image in await db.UniqueImage.objects.filter(has_architectural_page_number=None).all():
-      preproccesed = preprocess_image(bid_file_image.local_filename, (512, 512))
+      preproccesed = preprocess_image(resolve(bid_file_image.local_filename), (512, 512))
       print(preproccesed.shape)
       predictions = model.predict(preprocessed)
       print(predictions)
@@ -0,0 +1,42 @@
+import asyncio
+import os
+
+from app import db
+from app.storage import bid_file_key, copy_to_storage, textract_key, unique_image_key
+
+async def copy_rows(model, rows, column, key_for, batch_size=100):
+  # copies files still referenced by absolute path into storage and repoints the rows at their keys.
+  # The originals are left in place until the copy has been checked
+  rows = [row for row in rows if getattr(row, column) is not None and os.path.isabs(getattr(row, column))]
+  for i in range(0, len(rows), batch_size):
+    batch = []
+    for row in rows[i:i + batch_size]:
+      if os.path.exists(getattr(row, column)):
+        batch.append(row)
+      else:
+        print("Missing %s" % getattr(row, column))
+    keys = await asyncio.gather(*[
+      asyncio.to_thread(copy_to_storage, getattr(row, column), key_for(row))
+      for row in batch
+    ])
+    for row, key in zip(batch, keys):
+      setattr(row, column, key)
+    if len(batch) > 0:
+      await model.objects.bulk_update(batch, columns=[column])
+    print("Moved %s/%s %s" % (min(i + batch_size, len(rows)), len(rows), column))
+
+async def migrate_to_storage():
+  async with db.database:
+    async for unique_images in db.UniqueImage.iterate_batches(1000, fields=['md5_hash', 'local_filename', 'textract_filename']):
+      await copy_rows(db.UniqueImage, unique_images, 'local_filename', lambda row: unique_image_key(row.md5_hash))
+      await copy_rows(db.UniqueImage, unique_images, 'textract_filename', lambda row: textract_key(row.md5_hash))
+    async for bid_files in db.BCBidFile.iterate_batches(1000, fields=['local_filename'], local_filename__isnull=False):
+      await copy_rows(db.BCBidFile, bid_files, 'local_filename', lambda row: bid_file_key(row.id))
+
+
+if __name__ == '__main__':
+  import sys
+
+  asyncio.run(migrate_to_storage())
+
+  sys.exit()
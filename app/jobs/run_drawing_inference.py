@@ -1,47 +1,173 @@
-import math
-
 import asyncio
-import random
+import time
+
+import sqlalchemy
 
 from app import db
+from app.storage import resolve
+from app.config import settings
+from app.services.drawing_detector_service import DrawingDetectorService
+from app.services.prediction_cache_service import PredictionCacheService
+from app.services.task_queue_service import TaskQueueService
 
-from sklearn.model_selection import train_test_split
 import cv2
-import numpy as np
-from ultralytics import YOLO
 
+STAGE = 'run_drawing_inference'
 
+def load_images(unique_images):
+  # runs on a worker thread so the next batch is decoded while the model is busy
+  batch = []
+  for unique_image in unique_images:
+    image = cv2.imread(resolve(unique_image.local_filename), cv2.IMREAD_COLOR)
+    if image is None:
+      print("Couldn't read %s" % unique_image.local_filename)
+      continue
+    batch.append((unique_image, image))
+  return batch
 
-async def run_drawing_inference():
-  # Load pre-trained model
-  model = YOLO('/Users/harish/data/bidboard_training_data/drawing_number_yolov8/inference.pt')
-  idx = 0
-  async with db.database:
-    for unique_image in await db.UniqueImage.objects.select_related('unique_image_annotations').filter(has_architectural_page_number=True).all():
-      valid_roi = [anno for anno in unique_image.unique_image_annotations if anno.valid_roi == True]
-      if len(valid_roi) > 0:
-        continue
-      results = model(unique_image.local_filename)
-      if len(results[0].boxes.data) == 0:
+def boxes_to_prediction(boxes):
+  return {'boxes': [list(box) for box in boxes]}
+
+def prediction_to_boxes(prediction):
+  return [tuple(box) for box in prediction['boxes']]
+
+def build_annotations(unique_image, boxes):
+  annotations = []
+  for x1, y1, x2, y2, confidence in boxes:
+    annotation = db.UniqueImageAnnotation.construct(unique_image_id=unique_image.id)
+    annotation.page_number = 'a'
+    annotation.page_number_x1 = x1
+    annotation.page_number_x2 = x2
+    annotation.page_number_y1 = y1
+    annotation.page_number_y2 = y2
+    annotation.annotation_source = db.AnnotationSource.YOLO_MODEL_V1.value
+    annotation.confidence = confidence
+    annotations.append(annotation)
+  return annotations
+
+async def enqueue_unique_images(queue, retry_failed=False):
+  # drawings that don't have a validated roi yet
+  unique_images = db.UniqueImage.Meta.table
+  annotations = db.UniqueImageAnnotation.Meta.table
+  rows = await db.database.fetch_all(
+    sqlalchemy.select([unique_images.c.id]).where(sqlalchemy.and_(
+      unique_images.c.has_architectural_page_number == True,
+      ~unique_images.c.id.in_(
+        sqlalchemy.select([annotations.c.unique_image_id]).where(annotations.c.valid_roi == True)
+      )
+    ))
+  )
+  await queue.enqueue([row['id'] for row in rows], retry_failed=retry_failed)
+
+async def fetch_unique_images(unique_image_ids):
+  return await db.UniqueImage.fetch_rows(
+    ['id', 'md5_hash', 'local_filename'],
+    where=db.UniqueImage.Meta.table.c.id.in_(unique_image_ids)
+  )
+
+async def fetch_detector_annotated_ids(unique_image_ids):
+  if len(unique_image_ids) == 0:
+    return set()
+  annotations = db.UniqueImageAnnotation.Meta.table
+  rows = await db.database.fetch_all(
+    sqlalchemy.select([annotations.c.unique_image_id]).where(sqlalchemy.and_(
+      annotations.c.unique_image_id.in_(unique_image_ids),
+      annotations.c.annotation_source == db.AnnotationSource.YOLO_MODEL_V1.value
+    ))
+  )
+  return set(row['unique_image_id'] for row in rows)
+
+async def infer_drawings(detector, detector_lock, prediction_cache, unique_images):
+  # unique_images are rows from fetch_unique_images. Returns how many images went through
+  # the detector, how many came from the prediction cache, how many annotations were written,
+  # and the images the detector found a sheet number on
+  predictions = await prediction_cache.get_predictions([unique_image.md5_hash for unique_image in unique_images])
+  annotated_ids = await fetch_detector_annotated_ids([
+    unique_image.id for unique_image in unique_images if unique_image.md5_hash in predictions
+  ])
+  annotations = []
+  to_detect = []
+  found = []
+  cached = 0
+  for unique_image in unique_images:
+    if unique_image.md5_hash not in predictions:
+      to_detect.append(unique_image)
+      continue
+    # images whose prediction is already stored for this model skip the detector entirely,
+    # and only get annotations written if a previous run didn't already write them
+    cached += 1
+    boxes = prediction_to_boxes(predictions[unique_image.md5_hash])
+    if len(boxes) > 0:
+      found.append(unique_image)
+    if unique_image.id not in annotated_ids:
+      annotations.extend(build_annotations(unique_image, boxes))
+
+  batch = await asyncio.to_thread(load_images, to_detect)
+  if len(batch) > 0:
+    async with detector_lock:
+      detections = await asyncio.to_thread(detector.detect, [image for _, image in batch])
+    await prediction_cache.store_predictions({
+      unique_image.md5_hash: boxes_to_prediction(boxes)
+      for (unique_image, _), boxes in zip(batch, detections)
+    })
+    for (unique_image, _), boxes in zip(batch, detections):
+      if len(boxes) == 0:
         print("Couldn't identify annotation for %s" % unique_image.local_filename)
         continue
-      for i, _d in enumerate(results[0].boxes.data):
-        annotation = db.UniqueImageAnnotation.construct(unique_image_id=unique_image.id)
-        annotation.page_number = 'a'
-        annotation.page_number_x1 = math.floor(results[0].boxes.xyxy[i][0].item())
-        annotation.page_number_x2 = math.floor(results[0].boxes.xyxy[i][2].item())
-        annotation.page_number_y1 = math.floor(results[0].boxes.xyxy[i][1].item())
-        annotation.page_number_y2 = math.floor(results[0].boxes.xyxy[i][3].item())
-        annotation.annotation_source = db.AnnotationSource.YOLO_MODEL_V1.value
-        annotation.confidence = results[0].boxes.conf[i].item()
-        await annotation.save()
-        idx += 1
+      found.append(unique_image)
+      annotations.extend(build_annotations(unique_image, boxes))
+  if len(annotations) > 0:
+    await db.UniqueImageAnnotation.objects.bulk_create(annotations)
+  return len(batch), cached, len(annotations), found
+
+async def run_drawing_inference(batch_size=None, backend=None, enqueue=True, retry_failed=False):
+  if batch_size is None:
+    batch_size = settings.inference_batch_size
+  # Load pre-trained model
+  detector = DrawingDetectorService(backend).load()
+  async with db.database:
+    prediction_cache = PredictionCacheService(
+      db.database,
+      DrawingDetectorService.MODEL_ID,
+      detector.model_version(),
+      DrawingDetectorService.PREPROCESSING_VERSION
+    )
+    queue = TaskQueueService(db.database, STAGE)
+    if enqueue:
+      await enqueue_unique_images(queue, retry_failed)
+
+    # the model runs one batch at a time while the other claimed batches decode
+    detector_lock = asyncio.Lock()
+    num_detected = 0
+    num_cached = 0
+    num_annotations = 0
+
+    async def infer(unique_image_ids):
+      nonlocal num_detected, num_cached, num_annotations
+      unique_images = await fetch_unique_images(unique_image_ids)
+      detected, cached, annotations, _ = await infer_drawings(detector, detector_lock, prediction_cache, unique_images)
+      num_detected += detected
+      num_cached += cached
+      num_annotations += annotations
 
+    start = time.perf_counter()
+    await queue.work(infer, batch_size=batch_size, concurrency=settings.inference_prefetch_batches + 1)
+    elapsed = time.perf_counter() - start
+    print("Ran inference on %s images (%s from cache, %s annotations) in %.1fs, %.2f images/s" % (
+      num_detected,
+      num_cached,
+      num_annotations,
+      elapsed,
+      num_detected / elapsed if elapsed > 0 else 0
+    ))
 
 
 if __name__ == '__main__':
   import sys
 
-  asyncio.run(run_drawing_inference())
+  asyncio.run(run_drawing_inference(
+    enqueue='--worker' not in sys.argv,
+    retry_failed='--retry-failed' in sys.argv
+  ))
 
   sys.exit()
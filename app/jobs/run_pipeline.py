@@ -0,0 +1,242 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy
+
+from app import db
+from app.config import settings
+from app.services.bid_file_annotation_service import BidFileAnnotationService
+from app.services.building_connected_data_service import BuildingConnectedDataService
+from app.services.drawing_detector_service import DrawingDetectorService
+from app.services.prediction_cache_service import PredictionCacheService
+from app.jobs.extract_images import SKIPPED_BID_FILE_IDS
+from app.jobs.run_drawing_inference import fetch_unique_images, infer_drawings
+from app.jobs.textract_drawing_numbers import textract_drawing_number_on_unique_image
+from app.jobs.train_drawing_detector import load_drawing_classifier, score_drawings
+
+
+class Stage:
+  # a pool of workers draining a bounded queue. put() blocks once the queue is full, which is what
+  # holds back the stages upstream of a slow one. The stage shuts down after every producer feeding
+  # it has called producer_done
+  def __init__(self, name, handler, concurrency=1, batch_size=1, producers=1, queue_size=None):
+    self.name = name
+    self.handler = handler
+    self.concurrency = concurrency
+    self.batch_size = batch_size
+    self.producers = producers
+    self.queue = asyncio.Queue(maxsize=queue_size if queue_size is not None else settings.pipeline_queue_size)
+    self.processed = 0
+    self.failed = 0
+
+  async def put(self, item):
+    await self.queue.put(item)
+
+  async def producer_done(self):
+    self.producers -= 1
+    if self.producers == 0:
+      for _ in range(self.concurrency):
+        await self.queue.put(None)
+
+  async def worker(self):
+    while True:
+      item = await self.queue.get()
+      if item is None:
+        return
+      # batch up whatever is already waiting rather than waiting for a full batch
+      batch = [item]
+      finished = False
+      while len(batch) < self.batch_size and not self.queue.empty():
+        item = self.queue.get_nowait()
+        if item is None:
+          finished = True
+          break
+        batch.append(item)
+      try:
+        await self.handler(batch)
+      except Exception as e:
+        self.failed += len(batch)
+        print("%s failed on %s: %r" % (self.name, batch, e))
+      self.processed += len(batch)
+      if finished:
+        return
+
+  async def run(self, downstream=()):
+    await asyncio.gather(*[self.worker() for _ in range(self.concurrency)])
+    for stage in downstream:
+      await stage.producer_done()
+
+
+async def fetch_ids(query):
+  return [row['id'] for row in await db.database.fetch_all(query)]
+
+async def run_pipeline(scrape=True, backlog=True, textract=False, backend=None):
+  # scrape -> download -> extract -> classify -> detect (-> textract). Every stage passes ids on as
+  # soon as it's done with them, so a new bid file is rasterized, classified and annotated while the
+  # rest of the scrape is still downloading
+  detector = DrawingDetectorService(backend).load()
+  model, classifier_cache, tensor_cache = load_drawing_classifier(db.database)
+  async with db.database:
+    company = await db.Company.objects.get(name='Tristate Plumbing')
+    bcds = BuildingConnectedDataService(db.database, company)
+    bfas = BidFileAnnotationService(db.database)
+    detector_cache = PredictionCacheService(
+      db.database,
+      DrawingDetectorService.MODEL_ID,
+      detector.model_version(),
+      DrawingDetectorService.PREPROCESSING_VERSION
+    )
+    textract_service = None
+    if textract:
+      from app.services.textract_service import TextractService
+      textract_service = TextractService(db.database)
+    # a bid file is only queued for extraction once, whether it came from a download or the backlog,
+    # and pages shared between drawing sets only go down the pipeline once
+    seen_bid_file_ids = set(SKIPPED_BID_FILE_IDS)
+    seen_unique_image_ids = set()
+    detector_lock = asyncio.Lock()
+
+    async def download(bid_file_ids):
+      for bid_file in await bcds.cache_bid_files(await db.BCBidFile.objects.filter(id__in=bid_file_ids).all()):
+        if bid_file is not None and bid_file.mime_type == 'application/pdf' and not bid_file.images_extracted and \
+          bid_file.id not in seen_bid_file_ids:
+          seen_bid_file_ids.add(bid_file.id)
+          await extract_stage.put(bid_file.id)
+
+    async def extract(bid_file_ids):
+      for bid_file in await db.BCBidFile.objects.filter(id__in=bid_file_ids).all():
+        if await bfas.extract_images_in_pool(bid_file, executor) is None:
+          continue
+        for bid_file_image in await db.BCBidFileImage.objects.filter(bc_bid_file_id=bid_file.id).all():
+          unique_image_id = bid_file_image.unique_image_id.id
+          if unique_image_id not in seen_unique_image_ids:
+            seen_unique_image_ids.add(unique_image_id)
+            await classify_stage.put(unique_image_id)
+
+    async def classify(unique_image_ids):
+      unique_images = await db.UniqueImage.fetch_rows(
+        ['id', 'md5_hash', 'local_filename', 'architectural_page_number_probability'],
+        where=db.UniqueImage.Meta.table.c.id.in_(unique_image_ids)
+      )
+      _, _, probabilities = await score_drawings(model, classifier_cache, tensor_cache, unique_images, settings.classifier_batch_size)
+      for unique_image_id, probability in probabilities.items():
+        if probability > settings.pipeline_drawing_threshold:
+          await detect_stage.put(unique_image_id)
+
+    async def detect(unique_image_ids):
+      unique_images = await fetch_unique_images(unique_image_ids)
+      _, _, _, found = await infer_drawings(detector, detector_lock, detector_cache, unique_images)
+      if textract_service is not None:
+        for unique_image in found:
+          await textract_stage.put(unique_image.id)
+
+    async def analyze(unique_image_ids):
+      for unique_image in await db.UniqueImage.objects.filter(id__in=unique_image_ids).all():
+        if unique_image.textract_filename is None:
+          await textract_drawing_number_on_unique_image(textract_service, unique_image)
+
+    # the seeding coroutine below is a producer of every stage
+    download_stage = Stage('download', download, concurrency=settings.bc_download_concurrency, producers=1)
+    extract_stage = Stage('extract', extract, concurrency=settings.pdf_workers * 2, producers=2)
+    classify_stage = Stage('classify', classify, batch_size=settings.classifier_batch_size, producers=2)
+    detect_stage = Stage(
+      'detect',
+      detect,
+      concurrency=settings.inference_prefetch_batches + 1,
+      batch_size=settings.inference_batch_size,
+      producers=2
+    )
+    textract_stage = Stage('textract', analyze, concurrency=settings.pipeline_textract_concurrency, producers=2)
+    stages = [download_stage, extract_stage, classify_stage, detect_stage, textract_stage]
+
+    async def seed():
+      try:
+        if scrape:
+          # only new invitations; status changes on older bids need a full building_connected_scraper run
+          await bcds.sync_bids(incremental=True)
+        bid_files = db.BCBidFile.Meta.table
+        unique_images = db.UniqueImage.Meta.table
+        annotations = db.UniqueImageAnnotation.Meta.table
+        await bcds.init_session()
+        for bid_file_id in await fetch_ids(
+          sqlalchemy.select([bid_files.c.id]).where(sqlalchemy.and_(
+            bid_files.c.local_filename == None,
+            bid_files.c.download_url != None
+          ))
+        ):
+          await download_stage.put(bid_file_id)
+        if not backlog:
+          return
+        # work left over from interrupted runs, picked up with id only queries
+        for bid_file_id in await fetch_ids(
+          sqlalchemy.select([bid_files.c.id]).where(sqlalchemy.and_(
+            bid_files.c.local_filename != None,
+            bid_files.c.mime_type == 'application/pdf',
+            bid_files.c.images_extracted == False
+          ))
+        ):
+          if bid_file_id not in seen_bid_file_ids:
+            seen_bid_file_ids.add(bid_file_id)
+            await extract_stage.put(bid_file_id)
+        for unique_image_id in await fetch_ids(
+          sqlalchemy.select([unique_images.c.id]).where(unique_images.c.architectural_page_number_probability == None)
+        ):
+          if unique_image_id not in seen_unique_image_ids:
+            seen_unique_image_ids.add(unique_image_id)
+            await classify_stage.put(unique_image_id)
+        for unique_image_id in await fetch_ids(
+          sqlalchemy.select([unique_images.c.id]).where(sqlalchemy.and_(
+            unique_images.c.architectural_page_number_probability > settings.pipeline_drawing_threshold,
+            ~unique_images.c.id.in_(
+              sqlalchemy.select([annotations.c.unique_image_id]).where(sqlalchemy.or_(
+                annotations.c.valid_roi == True,
+                annotations.c.annotation_source == db.AnnotationSource.YOLO_MODEL_V1.value
+              ))
+            )
+          ))
+        ):
+          if unique_image_id not in seen_unique_image_ids:
+            seen_unique_image_ids.add(unique_image_id)
+            await detect_stage.put(unique_image_id)
+      finally:
+        for stage in stages:
+          await stage.producer_done()
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=settings.pdf_workers) as executor:
+      tasks = [
+        asyncio.create_task(seed()),
+        asyncio.create_task(download_stage.run([extract_stage])),
+        asyncio.create_task(extract_stage.run([classify_stage])),
+        asyncio.create_task(classify_stage.run([detect_stage])),
+        asyncio.create_task(detect_stage.run([textract_stage])),
+        asyncio.create_task(textract_stage.run())
+      ]
+      try:
+        await asyncio.gather(*tasks)
+      except BaseException:
+        # gather returns on the first error with the other stages still running, and they
+        # mustn't outlive the pool and the database connection they use
+        for task in tasks:
+          task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+      finally:
+        await bcds.close_session()
+
+    print("Pipeline finished in %.1fs" % (time.perf_counter() - start))
+    for stage in stages:
+      print("%-10s processed %s, failed %s" % (stage.name, stage.processed, stage.failed))
+
+
+if __name__ == '__main__':
+  import sys
+
+  asyncio.run(run_pipeline(
+    scrape='--no-scrape' not in sys.argv,
+    backlog='--no-backlog' not in sys.argv,
+    textract='--textract' in sys.argv
+  ))
+
+  sys.exit()
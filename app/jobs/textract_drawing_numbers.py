@@ -2,9 +2,15 @@ import asyncio
 import json
 import re
 
+import sqlalchemy
+
 from app import db
+from app.storage import resolve
 from app.services.textract_service import TextractService
 from app.services.bid_file_annotation_service import BidFileAnnotationService
+from app.services.task_queue_service import TaskQueueService
+
+STAGE = 'textract_drawing_numbers'
 
 async def validate_textract_results():
   pattern = r'^[A-Z]-?\d([\d .]*)?$'
@@ -16,7 +22,7 @@ async def validate_textract_results():
       if len(annos) > 0:
         print(annos[0].page_number)
       print(unique_image.textract_filename)
-      with open(unique_image.textract_filename, 'r') as file:
+      with open(resolve(unique_image.textract_filename), 'r') as file:
         textract_data = json.load(file)
       block_types = set()
       for block in textract_data['Blocks']:
@@ -33,25 +39,43 @@ async def textract_drawing_number_on_unique_image(textract_service, unique_image
   await textract_service.analyze_pdf(unique_image)
     
 
-async def textract_drawing_numbers():
+async def enqueue_unique_images(queue, retry_failed=False):
+  # images with a validated roi that haven't been through textract yet
+  unique_images = db.UniqueImage.Meta.table
+  annotations = db.UniqueImageAnnotation.Meta.table
+  rows = await db.database.fetch_all(
+    sqlalchemy.select([unique_images.c.id]).where(sqlalchemy.and_(
+      unique_images.c.textract_filename == None,
+      unique_images.c.id.in_(
+        sqlalchemy.select([annotations.c.unique_image_id]).where(annotations.c.valid_roi == True)
+      )
+    ))
+  )
+  await queue.enqueue([row['id'] for row in rows], retry_failed=retry_failed)
+
+async def textract_drawing_numbers(max_analyze=10, enqueue=True, retry_failed=False):
   async with db.database:
     textract_service = TextractService(db.database)
-    unique_image = await db.UniqueImage.objects.get_or_none(md5_hash='bbef6885f8b3eac5ae58dcb006a0fdc1')
-    await textract_drawing_number_on_unique_image(textract_service, unique_image)
-    return
-    max_analyze = 10
-    idx = 0
-    for anno in await db.UniqueImageAnnotation.objects.select_related('unique_image_id').filter(valid_roi=True).all():
-      await textract_drawing_number_on_unique_image(textract_service, anno.unique_image_id)
-      idx += 1
-      if idx >= max_analyze:
-        return
+    queue = TaskQueueService(db.database, STAGE)
+    if enqueue:
+      await enqueue_unique_images(queue, retry_failed)
+
+    async def analyze(unique_image_ids):
+      for unique_image in await db.UniqueImage.objects.filter(id__in=unique_image_ids).all():
+        await textract_drawing_number_on_unique_image(textract_service, unique_image)
+
+    # textract is billed per page, so each run only analyzes max_analyze images
+    analyzed = await queue.work(analyze, limit=max_analyze)
+    print("Analyzed %s images" % analyzed)
 
 
 if __name__ == '__main__':
   import sys
 
-  asyncio.run(textract_drawing_numbers())
+  asyncio.run(textract_drawing_numbers(
+    enqueue='--worker' not in sys.argv,
+    retry_failed='--retry-failed' in sys.argv
+  ))
   #asyncio.run(validate_textract_results())
 
   sys.exit()
@@ -1,8 +1,14 @@
 import asyncio
-import cv2
+import os
+import time
+
+import sqlalchemy
 
 from app import db
-from app.services.bid_file_annotation_service import BidFileAnnotationService
+from app.storage import resolve
+from app.config import settings
+from app.services.image_tensor_cache import ImageTensorCache
+from app.services.prediction_cache_service import PredictionCacheService, hash_model_files
 
 import tensorflow as tf
 from tensorflow.keras.models import Sequential
@@ -10,9 +16,13 @@ from tensorflow.keras.layers import GlobalAveragePooling2D, Dense, Input, Dropou
 from tensorflow.keras.applications import ResNet50
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.models import load_model
-import keras_tuner as kt
 import numpy as np
 
+DRAWING_CLASSIFIER_ID = 'architectural_drawing_resnet50'
+# bump when preprocess_image or the tensor cache changes what the classifier sees
+DRAWING_CLASSIFIER_PREPROCESSING_VERSION = 'gray_512_u8_v2'
+MODEL_TUNING_DIRECTORY = '/Users/harish/data/bidboard_models/model_tuning'
+MODEL_TUNING_PROJECT = 'arch_draw_tuning_expanded_search'
 
 def preprocess_image(image_path, image_size, augment=False):
   image = tf.io.read_file(image_path)
@@ -26,20 +36,71 @@ def preprocess_image(image_path, image_size, augment=False):
   image = image / 255.0  # Normalize to [0, 1]
   return image
 
+def build_tensor_cache(unique_images, image_size=(512, 512, 1), batch_size=256, cache=None):
+  # decodes and resizes only the images the cache hasn't seen yet, on every core. A long running
+  # caller passes its cache in rather than re-reading the whole index on every call
+  if cache is None:
+    cache = ImageTensorCache(settings.tensor_cache_path, image_size)
+  else:
+    cache.refresh()
+  local_filenames = {}
+  for unique_image in unique_images:
+    if unique_image.md5_hash in cache or unique_image.local_filename is None:
+      continue
+    local_filename = resolve(unique_image.local_filename)
+    if os.path.exists(local_filename):
+      local_filenames[unique_image.md5_hash] = local_filename
+  md5_hashes = list(local_filenames.keys())
+  if len(md5_hashes) == 0:
+    return cache
+
+  start = time.perf_counter()
+  dataset = tf.data.Dataset.from_tensor_slices([local_filenames[md5_hash] for md5_hash in md5_hashes])
+  dataset = dataset.map(
+    lambda x: tf.cast(tf.round(preprocess_image(x, image_size) * 255.0), tf.uint8),
+    num_parallel_calls=tf.data.AUTOTUNE,
+    deterministic=True
+  )
+  added = 0
+  for batch in dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE):
+    batch = batch.numpy()
+    cache.append(md5_hashes[added:added + len(batch)], batch)
+    added += len(batch)
+  print("Added %s images to the tensor cache in %.1fs" % (added, time.perf_counter() - start))
+  return cache
+
+def cached_image_dataset(cache, md5_hashes):
+  # reads rows straight out of the memory mapped cache instead of decoding pngs
+  array = cache.array()
+  image_size = cache.shape
+  def read_row(row):
+    image = tf.numpy_function(lambda i: array[i], [row], tf.uint8)
+    image.set_shape(image_size)
+    return tf.cast(image, tf.float32) / 255.0
+  dataset = tf.data.Dataset.from_tensor_slices(cache.row_indices(md5_hashes))
+  return dataset.map(read_row, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+
+def augment_image(image):
+  image = tf.image.random_flip_left_right(image)
+  return tf.image.random_flip_up_down(image)
+
 async def load_dataset(image_size=(512, 512, 1), augment=False):
-  image_paths = []
-  image_labels = []
+  labeled_images = []
 
   async with db.database:
-    for unique_image in await db.UniqueImage.objects.all():
-      if unique_image.has_architectural_page_number is None:
-        continue
-      image_paths.append(unique_image.local_filename)
-      image_labels.append(unique_image.has_architectural_page_number)
-
-  dataset = tf.data.Dataset.from_tensor_slices((image_paths, image_labels))
-  dataset = dataset.map(lambda x, y: (preprocess_image(x, image_size, augment), y))
+    async for unique_image in db.UniqueImage.iterate_rows(
+      ['md5_hash', 'local_filename', 'has_architectural_page_number'],
+      has_architectural_page_number__isnull=False
+    ):
+      labeled_images.append(unique_image)
+
+  cache = build_tensor_cache(labeled_images, image_size)
+  labeled_images = [unique_image for unique_image in labeled_images if unique_image.md5_hash in cache]
+  images = cached_image_dataset(cache, [unique_image.md5_hash for unique_image in labeled_images])
+  labels = tf.data.Dataset.from_tensor_slices([unique_image.has_architectural_page_number for unique_image in labeled_images])
+  dataset = tf.data.Dataset.zip((images, labels))
   if augment:
+    dataset = dataset.map(lambda x, y: (augment_image(x), y))
     dataset = dataset.map(lambda x, y: (tf.image.random_brightness(x, max_delta=0.1), y))
   return dataset
 
@@ -86,12 +147,14 @@ def build_model(hp):
     return model
 
 def tune_model(train_ds, val_ds):
+    import keras_tuner as kt
+
     tuner = kt.Hyperband(build_model,
                          objective='val_accuracy',
                          max_epochs=10,
                          factor=3,
-                         directory='/Users/harish/data/bidboard_models/model_tuning',
-                         project_name='arch_draw_tuning_expanded_search')
+                         directory=MODEL_TUNING_DIRECTORY,
+                         project_name=MODEL_TUNING_PROJECT)
     tuner.reload()  # This reloads the tuner from the saved directory
     best_model = tuner.get_best_models(num_models=1)[0]
     return best_model
@@ -142,21 +205,119 @@ async def train_drawing_detector(batch_size, augment):
   #best_model.save('/Users/harish/data/bidboard_models/dropout_tuned_drawing_model_optimized.keras')
 
 
-async def flag_drawings():
+def build_scoring_dataset(cache, md5_hashes, batch_size):
+  # rows are read on every core while the model works through the previous batch
+  return cached_image_dataset(cache, md5_hashes).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+def set_drawing_probability(probabilities, unique_image, yes_drawing):
+  # unique_image is a read only row, so the new probability is recorded in probabilities
+  probabilities[unique_image.id] = yes_drawing
+  return unique_image.architectural_page_number_probability != yes_drawing
+
+async def save_drawing_probabilities(probabilities, chunk_size=1000):
+  # probabilities maps unique image id to its new probability. Each chunk is a single
+  # UPDATE ... SET probability = CASE id WHEN ... END. The ids are bound through the id column's
+  # type and the probabilities are cast, so postgres never has to guess a parameter's type
+  unique_images = db.UniqueImage.Meta.table
+  items = list(probabilities.items())
+  for i in range(0, len(items), chunk_size):
+    chunk = items[i:i + chunk_size]
+    await db.database.execute(
+      unique_images.update()
+        .where(unique_images.c.id.in_([unique_image_id for unique_image_id, _ in chunk]))
+        .values(architectural_page_number_probability=sqlalchemy.case(
+          [
+            (
+              sqlalchemy.literal(unique_image_id, unique_images.c.id.type),
+              sqlalchemy.cast(probability, sqlalchemy.Float)
+            )
+            for unique_image_id, probability in chunk
+          ],
+          value=unique_images.c.id
+        ))
+    )
+
+def load_drawing_classifier(database):
   #print(build_fixed_model().summary())
   #model = load_model('/Users/harish/data/bidboard_models/dropout_tuned_drawing_model_optimized.keras', custom_objects={'GrayscaleToRGB': GrayscaleToRGB})
   model = tune_model([], [])
   #print(model.summary())
+  # the oracle records the best trial, so it changes whenever the tuned model does
+  model_version = hash_model_files(os.path.join(MODEL_TUNING_DIRECTORY, MODEL_TUNING_PROJECT, 'oracle.json'))
+  prediction_cache = PredictionCacheService(
+    database,
+    DRAWING_CLASSIFIER_ID,
+    model_version,
+    DRAWING_CLASSIFIER_PREPROCESSING_VERSION
+  )
+  # opened once here and shared by every score_drawings call
+  tensor_cache = ImageTensorCache(settings.tensor_cache_path)
+  return model, prediction_cache, tensor_cache
+
+async def score_drawings(model, prediction_cache, tensor_cache, unique_images, batch_size):
+  # unique_images are rows with id, md5_hash, local_filename and architectural_page_number_probability.
+  # Runs the model only on images without a cached prediction and saves the probabilities that changed.
+  # Returns how many were scored, how many came from the cache, and {unique_image_id: probability}
+  to_score = []
+  cached = 0
+  probabilities = {}
+  for i in range(0, len(unique_images), 1000):
+    chunk = unique_images[i:i + 1000]
+    predictions = await prediction_cache.get_predictions([unique_image.md5_hash for unique_image in chunk])
+    updated = {}
+    for unique_image in chunk:
+      if unique_image.md5_hash in predictions:
+        cached += 1
+        _, yes_drawing = predictions[unique_image.md5_hash]['probabilities']
+        if set_drawing_probability(probabilities, unique_image, yes_drawing):
+          updated[unique_image.id] = yes_drawing
+      elif unique_image.local_filename is not None:
+        to_score.append(unique_image)
+    await save_drawing_probabilities(updated)
+
+  await asyncio.to_thread(build_tensor_cache, to_score, tensor_cache.shape, cache=tensor_cache)
+  to_score = [unique_image for unique_image in to_score if unique_image.md5_hash in tensor_cache]
+  scored = 0
+  batches = build_scoring_dataset(tensor_cache, [unique_image.md5_hash for unique_image in to_score], batch_size)
+  for batch in batches:
+    batch_probabilities = await asyncio.to_thread(model.predict_on_batch, batch)
+    batch_images = to_score[scored:scored + len(batch_probabilities)]
+    scored += len(batch_probabilities)
+    new_predictions = {}
+    updated = {}
+    for unique_image, (no_drawing, yes_drawing) in zip(batch_images, batch_probabilities.tolist()):
+      new_predictions[unique_image.md5_hash] = {'probabilities': [no_drawing, yes_drawing]}
+      if set_drawing_probability(probabilities, unique_image, yes_drawing):
+        updated[unique_image.id] = yes_drawing
+    await prediction_cache.store_predictions(new_predictions)
+    await save_drawing_probabilities(updated)
+  return scored, cached, probabilities
+
+async def flag_drawings(batch_size=None):
+  if batch_size is None:
+    batch_size = settings.classifier_batch_size
+  model, prediction_cache, tensor_cache = load_drawing_classifier(db.database)
   #bfas = BidFileAnnotationService(db.database)  
   async with db.database:
-    for bid_file_image in await db.UniqueImage.objects.all():
-      preproccesed = preprocess_image(bid_file_image.local_filename, (512, 512))
-      [[no_drawing, yes_drawing]] = model.predict(np.expand_dims(preproccesed, axis=0))
-      bid_file_image.architectural_page_number_probability = yes_drawing
-      await bid_file_image.update()
-      if yes_drawing <= no_drawing:
-         continue
-      #await bfas.flag_architectural_page_number(bid_file_image)
+    start = time.perf_counter()
+    scored = 0
+    cached = 0
+    # a thousand images at a time, so memory doesn't grow with the table. Rows are plain tuples,
+    # nothing here needs a full model
+    async for unique_images in db.UniqueImage.iterate_row_batches(
+      ['id', 'md5_hash', 'local_filename', 'architectural_page_number_probability'],
+      1000
+    ):
+      batch_scored, batch_cached, _ = await score_drawings(model, prediction_cache, tensor_cache, unique_images, batch_size)
+      scored += batch_scored
+      cached += batch_cached
+    elapsed = time.perf_counter() - start
+    print("Scored %s images (%s more from cache) in %.1fs, %.2f images/s" % (
+      scored,
+      cached,
+      elapsed,
+      scored / elapsed if elapsed > 0 else 0
+    ))
 
 
 if __name__ == '__main__':
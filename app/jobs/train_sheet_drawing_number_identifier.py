@@ -1,40 +1,142 @@
 import asyncio
-import random
+import concurrent.futures
+import hashlib
+import json
+import os
 
 from app import db
+from app.storage import resolve
 
-from sklearn.model_selection import train_test_split
 import cv2
-import numpy as np
-from ultralytics import YOLO
 
+TRAINING_IMAGE_SIZE = 1280
+TRAIN_FRACTION = 0.7
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def split_for(md5_hash):
+  # stable across runs, so an image never moves between train and val as labels are added
+  bucket = int(hashlib.sha1(md5_hash.encode('utf-8')).hexdigest()[:8], 16) / 0xffffffff
+  return 'train' if bucket < TRAIN_FRACTION else 'val'
+
+def hash_boxes(boxes):
+  return hashlib.sha1(json.dumps(sorted(boxes)).encode('utf-8')).hexdigest()
+
+def dataset_paths(md5_hash, split):
+  # sharded by hash prefix so no directory ends up with tens of thousands of files
+  image_path = os.path.join(split, 'images', md5_hash[:2], '%s.jpg' % md5_hash)
+  label_path = os.path.join(split, 'labels', md5_hash[:2], '%s.txt' % md5_hash)
+  return image_path, label_path
+
+def write_atomically(path, data, mode='w'):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = "%s.tmp" % path
+  with open(tmp_path, mode) as f:
+    f.write(data)
+  os.replace(tmp_path, path)
+
+def export_training_image(local_filename, image_path, label_path, boxes, width=None, height=None):
+  # runs in a worker process; only decodes the source when the image itself has to be written
+  if width is None or height is None:
+    image = cv2.imread(resolve(local_filename), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+      return None
+    height, width = image.shape[:2]
+    # yolo letterboxes to the training size anyway, so resize once here instead of every epoch
+    scale = TRAINING_IMAGE_SIZE / max(width, height)
+    if scale < 1:
+      image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', image)
+    if not ok:
+      return None
+    write_atomically(image_path, encoded.tobytes(), mode='wb')
+
+  # labels are relative to the image size, so they're the same before and after resizing
+  lines = []
+  for x1, y1, x2, y2 in boxes:
+    x_center = (x1 + x2) * 0.5
+    y_center = (y1 + y2) * 0.5
+    lines.append(f'0 {x_center / width} {y_center / height} {(x2 - x1) / width} {(y2 - y1) / height}\n')
+  write_atomically(label_path, ''.join(lines))
+  return width, height
 
 async def load_image_and_boxes(path):
-  idx = 0
+  manifest_path = os.path.join(path, MANIFEST_FILENAME)
+  manifest = {}
+  if os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+
   async with db.database:
+    images = {}
     for anno in await db.UniqueImageAnnotation.objects.select_related('unique_image_id').filter(valid_roi=True).all():
-      train_val = 'train' if random.random() < 0.7 else 'val'
-      data_path = "%s/%s" % (path, train_val)
+      unique_image = anno.unique_image_id
+      if unique_image.md5_hash not in images:
+        images[unique_image.md5_hash] = (unique_image.local_filename, [])
+      images[unique_image.md5_hash][1].append(
+        (anno.page_number_x1, anno.page_number_y1, anno.page_number_x2, anno.page_number_y2)
+      )
 
-      image = cv2.imread(anno.unique_image_id.local_filename, cv2.IMREAD_GRAYSCALE)
-      height, width = image.shape[:2]
-      image = np.expand_dims(image, axis=-1)  # Add channel dimension
+  # images that lost all their valid annotations leave the dataset
+  removed = [md5_hash for md5_hash in manifest if md5_hash not in images]
+  for md5_hash in removed:
+    for relative_path in dataset_paths(md5_hash, manifest[md5_hash]['split']):
+      if os.path.exists(os.path.join(path, relative_path)):
+        os.remove(os.path.join(path, relative_path))
+    del manifest[md5_hash]
 
-      x_center = (anno.page_number_x1 + anno.page_number_x2) * 0.5
-      y_center = (anno.page_number_y1 + anno.page_number_y2) * 0.5
-      box_width = anno.page_number_x2 - anno.page_number_x1
-      box_height = anno.page_number_y2 - anno.page_number_y1
+  loop = asyncio.get_running_loop()
+  tasks = []
+  with concurrent.futures.ProcessPoolExecutor() as executor:
+    for md5_hash, (local_filename, boxes) in images.items():
+      split = split_for(md5_hash)
+      boxes_hash = hash_boxes(boxes)
+      image_path, label_path = [os.path.join(path, relative_path) for relative_path in dataset_paths(md5_hash, split)]
+      entry = manifest.get(md5_hash)
+      if entry is not None and entry['boxes_hash'] == boxes_hash and os.path.exists(image_path):
+        continue
+      # a relabelled image only needs its label file rewritten
+      width, height = None, None
+      if entry is not None and os.path.exists(image_path):
+        width, height = entry['width'], entry['height']
+      future = loop.run_in_executor(
+        executor,
+        export_training_image,
+        local_filename,
+        image_path,
+        label_path,
+        boxes,
+        width,
+        height
+      )
+      tasks.append((md5_hash, split, boxes_hash, future))
 
-      image_path = "%s/images/image_%s.jpg" % (data_path, idx)
-      cv2.imwrite(image_path, image)
-      label_path = "%s/labels/image_%s.txt" % (data_path, idx)
-      with open(label_path, 'w') as file:
-        file.write(f'0 {x_center / width} {y_center / height} {box_width / width} {box_height / height}')
-        file.write("\n")
-      idx+=1
+    skipped = 0
+    for md5_hash, split, boxes_hash, future in tasks:
+      size = await future
+      if size is None:
+        print("Couldn't export %s" % images[md5_hash][0])
+        skipped += 1
+        continue
+      manifest[md5_hash] = {
+        'split': split,
+        'boxes_hash': boxes_hash,
+        'width': size[0],
+        'height': size[1]
+      }
+
+  write_atomically(manifest_path, json.dumps(manifest, indent=2, sort_keys=True))
+  print("Exported %s images (%s unchanged, %s removed, %s failed)" % (
+    len(tasks) - skipped,
+    len(images) - len(tasks),
+    len(removed),
+    skipped
+  ))
 
 
 async def train_model():
+  from ultralytics import YOLO
+
   #await load_image_and_boxes('/Users/harish/data/bidboard_training_data/drawing_number_yolov8')
   # Load pre-trained model
   model = YOLO('/Users/harish/data/bidboard_training_data/drawing_number_yolov8/yolov8n.pt')
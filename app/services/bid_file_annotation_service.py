@@ -1,178 +1,253 @@
+import asyncio
+import datetime
 import os
 import hashlib
 import io
-from sqlalchemy import or_
+import uuid
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
 
 from databases import Database
-from pdf2image import convert_from_path
-from pdf2image.exceptions import PDFPageCountError
-from pathlib import Path
 import cv2
 import numpy as np
-import pytesseract
 from PIL import Image
-from PyQt5.QtWidgets import QApplication, QLabel, QWidget, QVBoxLayout
-from PyQt5.QtGui import QPixmap, QPainter, QPen, QImage
-from PyQt5.QtCore import Qt, QPoint, QTimer, QRect
 
 from app import db
+from app.config import settings
+from app.services.ocr_service import get_ocr_backend
+from app.storage import get_storage, resolve, unique_image_key
 
 Image.MAX_IMAGE_PIXELS = None
 
-class BoundingBoxApp(QWidget):
-  def __init__(self, imageArray):
-    super().__init__()
-    self.imageArray = imageArray
-    self.initUI()
-
-  def initUI(self):
-    self.setWindowTitle("Bounding Box Drawer")
-    self.setGeometry(100, 100, 1200, 900)
-
-    self.layout = QVBoxLayout()
-    self.imageLabel = QLabel(self)
-    self.imageLabel.setAlignment(Qt.AlignCenter)
-    self.layout.addWidget(self.imageLabel)
-    self.setLayout(self.layout)
-    QTimer.singleShot(100, self.loadImage)  # Load image after everything is initialized
-
-  def loadImage(self):
-    height, width, channel = self.imageArray.shape
-    bytesPerLine = 3 * width
-    qImg = QImage(self.imageArray.tobytes(), width, height, bytesPerLine, QImage.Format_RGB888).rgbSwapped()
-    self.pixmap = QPixmap.fromImage(qImg)
-    self.scaledPixmap = self.pixmap.scaled(self.imageLabel.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-
-    # Calculate scale factors
-    self.scaleW = self.pixmap.width() / self.scaledPixmap.width()
-    self.scaleH = self.pixmap.height() / self.scaledPixmap.height()
-
-    self.imageLabel.setPixmap(self.scaledPixmap)
-    self.imageLabel.setContentsMargins(0, 0, 0, 0)  # No margins
-    self.imageLabel.setAlignment(Qt.AlignTop | Qt.AlignLeft)  # Align to the top left
-
-    # Initializing drawing state
-    self.startPoint = QPoint()
-    self.endPoint = QPoint()
-    self.drawing = False
-
-    # Connect mouse events
-    self.imageLabel.mousePressEvent = self.mousePressEvent
-    self.imageLabel.mouseMoveEvent = self.mouseMoveEvent
-    self.imageLabel.mouseReleaseEvent = self.mouseReleaseEvent
-
-    self.cancelled = False
-
-  def getBoundingBoxCoords(self):
-    if self.cancelled:
-      return None
-    origX1 = int(min([self.startPoint.x(), self.endPoint.x()]) * self.scaleW)
-    origY1 = int(min([self.startPoint.y(), self.endPoint.y()]) * self.scaleH)
-    origX2 = int(max([self.startPoint.x(), self.endPoint.x()]) * self.scaleW)
-    origY2 = int(max([self.startPoint.y(), self.endPoint.y()]) * self.scaleH)
-    print(self.scaleH)
-    print(self.startPoint.y())
-    return (origX1, origY1, origX2, origY2)
-
-  def mousePressEvent(self, event):
-    if event.button() == Qt.LeftButton:
-      self.drawing = True
-      self.startPoint = event.pos()
-      self.endPoint = event.pos()
-
-  def mouseMoveEvent(self, event):
-    if event.buttons() & Qt.LeftButton and self.drawing:
-      self.endPoint = event.pos()
-      self.updateDrawing()
-
-  def mouseReleaseEvent(self, event):
-    if event.button() == Qt.LeftButton:
-      self.drawing = False
-      self.endPoint = event.pos()
-      self.updateDrawing()
-
-  def keyPressEvent(self, event):
-    key = event.key()
-    if key in (Qt.Key_Escape, Qt.Key_Return, Qt.Key_Enter):
-      if key == Qt.Key_Escape:
-        self.cancelled = True
-      self.close()
-
-  def updateDrawing(self):
-    tempPixmap = self.scaledPixmap.copy()
-    painter = QPainter(tempPixmap)
-    pen = QPen(Qt.red, 2, Qt.SolidLine)
-    painter.setPen(pen)
-    rect = QRect(self.startPoint, self.endPoint)
-    painter.drawRect(rect)
-    painter.end()
-    self.imageLabel.setPixmap(tempPixmap)
+def get_pdf_page_count(local_filename):
+  from pdf2image import pdfinfo_from_path
+  return pdfinfo_from_path(local_filename)['Pages']
+
+def iter_pdf_page_windows(local_filename, dpi=300, page_window=1, first_page=1, last_page=None):
+  # only page_window pages are rasterized at a time, so peak memory is bounded
+  # by the window rather than by the length of the drawing set
+  from pdf2image import convert_from_path
+  if last_page is None:
+    last_page = get_pdf_page_count(local_filename)
+  for window_start in range(first_page, last_page + 1, page_window):
+    window_end = min(window_start + page_window - 1, last_page)
+    pages = convert_from_path(local_filename, dpi=dpi, first_page=window_start, last_page=window_end)
+    yield [(window_start + offset, page) for offset, page in enumerate(pages)]
+    for page in pages:
+      page.close()
+    pages = None
+
+def iter_pdf_pages(local_filename, dpi=300, page_window=1, first_page=1, last_page=None):
+  for window in iter_pdf_page_windows(local_filename, dpi=dpi, page_window=page_window, first_page=first_page, last_page=last_page):
+    for page_number, page in window:
+      yield page_number, page
+
+def get_pixel_hasher(algorithm):
+  if algorithm == 'md5':
+    return hashlib.md5()
+  if algorithm == 'xxhash':
+    import xxhash
+    return xxhash.xxh3_128()
+  if algorithm == 'blake3':
+    from blake3 import blake3
+    return blake3()
+  raise ValueError("Unknown image hash algorithm %s" % algorithm)
+
+def encode_page(page):
+  img_byte_arr = io.BytesIO()
+  page.save(img_byte_arr, format='PNG')
+  return img_byte_arr.getvalue()
+
+def hash_page(page, algorithm=None):
+  # returns the hash and, when it had to be computed along the way, the encoded png
+  if algorithm is None:
+    algorithm = settings.image_hash_algorithm
+  if algorithm == 'png_md5':
+    encoded = encode_page(page)
+    return hashlib.md5(encoded).hexdigest(), encoded
+  hasher = get_pixel_hasher(algorithm)
+  hasher.update(('%s %sx%s' % (page.mode, page.width, page.height)).encode())
+  hasher.update(page.tobytes())
+  return hasher.hexdigest(), None
+
+def write_page(page, image_key, encoded=None):
+  if encoded is None:
+    encoded = encode_page(page)
+  get_storage().write_bytes(image_key, encoded)
+
+def save_page(page, hash_algorithm=None):
+  md5_hash, encoded = hash_page(page, hash_algorithm)
+  image_key = unique_image_key(md5_hash)
+  # images are content addressed, so an existing file means this page was already written
+  if not get_storage().exists(image_key):
+    write_page(page, image_key, encoded)
+  return image_key, md5_hash
+
+def rasterize_page_range(local_filename, first_page, last_page, dpi, page_window):
+  # runs in a worker process, so only the (page_number, image_key, md5_hash) tuples
+  # are sent back to the event loop rather than the rendered pages
+  extracted_pages = []
+  for page_number, page in iter_pdf_pages(local_filename, dpi=dpi, page_window=page_window, first_page=first_page, last_page=last_page):
+    image_key, md5_hash = save_page(page)
+    extracted_pages.append((page_number, image_key, md5_hash))
+  return extracted_pages
 
 class BidFileAnnotationService:
-  LOCAL_FILENAME_PATH = '/Users/harish/data/bidboard_images'
+  # extract_images renders sheets at 300 dpi
+  SOURCE_DPI = 300
 
-  def __init__(self, db: Database):
+  def __init__(self, db: Database, ocr_backend=None):
     self.db = db
+    self._ocr_backend = ocr_backend
+
+  @property
+  def ocr_backend(self):
+    # loaded on first use, so extraction (and the pool workers it forks) never load tesseract
+    if self._ocr_backend is None:
+      self._ocr_backend = get_ocr_backend()
+    return self._ocr_backend
+
+  async def get_known_hashes(self, md5_hashes):
+    unique_images = db.UniqueImage.Meta.table
+    rows = await self.db.fetch_all(
+      sqlalchemy.select([unique_images.c.md5_hash]).where(unique_images.c.md5_hash.in_(md5_hashes))
+    )
+    return set([row['md5_hash'] for row in rows])
 
-  async def upsert_bid_file_image(self, bid_file, page_number, local_filename, md5_hash):
-    unique_image = await db.UniqueImage.objects.get_or_none(md5_hash=md5_hash)
-    if unique_image is None:
-      unique_image = db.UniqueImage.construct(
-        md5_hash=md5_hash,
-        local_filename=local_filename
+  async def bulk_upsert_bid_file_images(self, bid_file, extracted_pages):
+    # extracted_pages is a list of (page_number, local_filename, md5_hash) for a whole pdf,
+    # written with a fixed number of statements regardless of the page count
+    if len(extracted_pages) == 0:
+      return
+    now = datetime.datetime.utcnow()
+    unique_images = db.UniqueImage.Meta.table
+    bid_file_images = db.BCBidFileImage.Meta.table
+
+    unique_image_rows = {}
+    for _, local_filename, md5_hash in extracted_pages:
+      unique_image_rows[md5_hash] = {
+        'id': uuid.uuid4(),
+        'created_at': now,
+        'md5_hash': md5_hash,
+        'local_filename': local_filename
+      }
+    # insert in a consistent order so concurrent documents sharing images can't deadlock
+    md5_hashes = sorted(unique_image_rows.keys())
+
+    async with self.db.transaction():
+      await self.db.execute(
+        insert(unique_images)
+          .values([unique_image_rows[md5_hash] for md5_hash in md5_hashes])
+          .on_conflict_do_nothing(index_elements=['md5_hash'])
+      )
+      rows = await self.db.fetch_all(
+        sqlalchemy.select([unique_images.c.id, unique_images.c.md5_hash]).where(unique_images.c.md5_hash.in_(md5_hashes))
+      )
+      unique_image_ids = {row['md5_hash']: row['id'] for row in rows}
+
+      insert_bid_file_images = insert(bid_file_images).values([
+        {
+          'id': uuid.uuid4(),
+          'created_at': now,
+          'bc_bid_file_id': bid_file.id,
+          'page_number': page_number,
+          'unique_image_id': unique_image_ids[md5_hash]
+        }
+        for page_number, _, md5_hash in sorted(extracted_pages)
+      ])
+      await self.db.execute(
+        insert_bid_file_images.on_conflict_do_update(
+          index_elements=['bc_bid_file_id', 'page_number'],
+          set_={
+            'unique_image_id': insert_bid_file_images.excluded.unique_image_id,
+            'updated_at': now
+          }
+        )
       )
-      await unique_image.save()
-    else:
-      print("Found dupe image %s" % md5_hash)
-    created = True
-    bid_file_image = await db.BCBidFileImage.objects.get_or_none(
-      bc_bid_file_id=bid_file.id,
-      page_number=page_number
-    )
-    if bid_file_image is None:
-      created = False
-      bid_file_image = db.BCBidFileImage.construct(bc_bid_file_id=bid_file.id, page_number=page_number)
-    bid_file_image.unique_image_id=unique_image.id
-    if created is False:
-      await bid_file_image.save()
-    else:
-      await bid_file_image.update()
-    
-    return bid_file_image
 
-  async def extract_images(self, bid_file, dpi=300, force=False):
+  async def extract_images(self, bid_file, dpi=300, force=False, page_window=None):
     if bid_file.local_filename is None or bid_file.mime_type != 'application/pdf':
       return
 
     if bid_file.images_extracted and not force:
       return
 
+    if page_window is None:
+      page_window = settings.pdf_page_window
+
+    from pdf2image.exceptions import PDFPageCountError
+    local_filename = resolve(bid_file.local_filename)
     try:
-      pages = convert_from_path(bid_file.local_filename, dpi=dpi)
+      page_count = get_pdf_page_count(local_filename)
     except PDFPageCountError:
       print("Could not extract pages from %s" % bid_file.id)
       return
-    for i, page in enumerate(pages):
-      page_number = i + 1
-
-      hasher = hashlib.md5()
-      img_byte_arr = io.BytesIO()
-      page.save(img_byte_arr, format='PNG')  # You can choose PNG or other formats depending on the image
-      img_byte_arr = img_byte_arr.getvalue()
-      hasher.update(img_byte_arr)
-      md5_hash = hasher.hexdigest()
-      image_path = f'{os.path.join(BidFileAnnotationService.LOCAL_FILENAME_PATH, md5_hash)}.png'
-      page.save(image_path, 'PNG')
-      await self.upsert_bid_file_image(bid_file, page_number, image_path, md5_hash)
-      print(f"Saved: {image_path}")
+    extracted_pages = []
+    for window in iter_pdf_page_windows(local_filename, dpi=dpi, page_window=page_window, last_page=page_count):
+      hashed_pages = [(page_number, page) + hash_page(page) for page_number, page in window]
+      known_hashes = await self.get_known_hashes([md5_hash for _, _, md5_hash, _ in hashed_pages])
+      for page_number, page, md5_hash, encoded in hashed_pages:
+        image_key = unique_image_key(md5_hash)
+        if md5_hash not in known_hashes:
+          write_page(page, image_key, encoded)
+          known_hashes.add(md5_hash)
+          print(f"Saved: {image_key}")
+        extracted_pages.append((page_number, image_key, md5_hash))
+      hashed_pages = None
+    await self.bulk_upsert_bid_file_images(bid_file, extracted_pages)
     
     bid_file.images_extracted = True
     await bid_file.update()
 
     return bid_file
+
+  async def extract_images_in_pool(self, bid_file, executor, dpi=300, force=False, pages_per_task=None, page_window=None):
+    if bid_file.local_filename is None or bid_file.mime_type != 'application/pdf':
+      return
+
+    if bid_file.images_extracted and not force:
+      return
+
+    if pages_per_task is None:
+      pages_per_task = settings.pdf_pages_per_task
+    if page_window is None:
+      page_window = settings.pdf_page_window
+
+    from pdf2image.exceptions import PDFPageCountError
+    # fetched once here rather than by every worker when storage is remote
+    local_filename = await asyncio.to_thread(resolve, bid_file.local_filename)
+    try:
+      page_count = await asyncio.to_thread(get_pdf_page_count, local_filename)
+    except PDFPageCountError:
+      print("Could not extract pages from %s" % bid_file.id)
+      return
+
+    loop = asyncio.get_running_loop()
+    futures = [
+      loop.run_in_executor(
+        executor,
+        rasterize_page_range,
+        local_filename,
+        first_page,
+        min(first_page + pages_per_task - 1, page_count),
+        dpi,
+        page_window
+      )
+      for first_page in range(1, page_count + 1, pages_per_task)
+    ]
+    extracted_pages = []
+    for page_range in await asyncio.gather(*futures):
+      extracted_pages.extend(page_range)
+    await self.bulk_upsert_bid_file_images(bid_file, extracted_pages)
+    print("Saved %s pages from %s" % (len(extracted_pages), bid_file.id))
+
+    bid_file.images_extracted = True
+    await bid_file.update()
+
+    return bid_file
   
   async def flag_architectural_page_number(self, bid_file_image):
-    image = cv2.imread(bid_file_image.local_filename)
+    image = cv2.imread(resolve(bid_file_image.local_filename))
     cv2.imshow('Does this have an architectural page number?', image)
     key = cv2.waitKey(0)
     if key == ord('y'):
@@ -185,32 +260,57 @@ class BidFileAnnotationService:
     await bid_file_image.update()
     cv2.destroyAllWindows()
 
-  def extract_coordinates_from_ocr_result(self, ocr_result, idx, border_size):
+  def extract_coordinates_from_ocr_result(self, ocr_result, idx, border_size, scale=1.0):
     return {
-      'x1': ocr_result['left'][idx] - border_size,
-      'y1': ocr_result['top'][idx] - border_size,
-      'x2': ocr_result['left'][idx] - border_size + ocr_result['width'][idx],
-      'y2': ocr_result['top'][idx] - border_size + ocr_result['height'][idx]
+      'x1': int(round((ocr_result['left'][idx] - border_size) / scale)),
+      'y1': int(round((ocr_result['top'][idx] - border_size) / scale)),
+      'x2': int(round((ocr_result['left'][idx] - border_size + ocr_result['width'][idx]) / scale)),
+      'y2': int(round((ocr_result['top'][idx] - border_size + ocr_result['height'][idx]) / scale))
     }
 
-  def extract_page_number(self, binary_inverted_image, psm=12, debug=False):
+  def prepare_for_ocr(self, binary_inverted_image, padding_mode=None):
+    # wide pads the crop by its own width on every side (the original behaviour), tight only
+    # adds a small fixed margin. Returns the image for the ocr engine, the border added
+    # around the crop and the scale applied to it
+    if padding_mode is None:
+      padding_mode = settings.ocr_padding_mode
     # Get the dimensions of the image
-    _, width = binary_inverted_image.shape[:2]
+    height, width = binary_inverted_image.shape[:2]
 
     kernel = np.ones((3, 3), np.uint8)
     dilation = cv2.dilate(binary_inverted_image, kernel, iterations=1)
     reverted_dilation = cv2.bitwise_not(dilation)
 
-    border_size = width
+    scale = 1.0
+    if padding_mode == 'wide':
+      border_size = width
+    elif padding_mode == 'tight':
+      border_size = settings.ocr_tight_margin
+      if settings.ocr_target_dpi is not None and settings.ocr_target_dpi != BidFileAnnotationService.SOURCE_DPI:
+        scale = settings.ocr_target_dpi / BidFileAnnotationService.SOURCE_DPI
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+        reverted_dilation = cv2.resize(
+          reverted_dilation,
+          (max(int(width * scale), 1), max(int(height * scale), 1)),
+          interpolation=interpolation
+        )
+    else:
+      raise ValueError("Unknown ocr padding mode %s" % padding_mode)
+
     bordered_image = cv2.copyMakeBorder(reverted_dilation, border_size, border_size, border_size, border_size, cv2.BORDER_CONSTANT, value=[255, 255, 255])
+    return bordered_image, border_size, scale
+
+  def extract_page_number(self, binary_inverted_image, psm=12, debug=False, padding_mode=None):
+    bordered_image, border_size, scale = self.prepare_for_ocr(binary_inverted_image, padding_mode=padding_mode)
+    # Perform OCR on the cropped image
+    ocr_result = self.ocr_backend.image_to_data(bordered_image, psm)
+    return self.select_page_number(ocr_result, bordered_image, border_size, scale=scale, debug=debug)
 
+  def select_page_number(self, ocr_result, bordered_image, border_size, scale=1.0, debug=False):
     page_number_text = None
     page_number_coordinates = None
-    # Perform OCR on the cropped image
-    custom_config = "--oem 1 --psm %s" % psm
-    ocr_result = pytesseract.image_to_data(Image.fromarray(bordered_image), output_type=pytesseract.Output.DICT, config=custom_config)
-    
     bordered_height, bordered_width = bordered_image.shape[:2]
+    crop_height = bordered_height - 2 * border_size
     # Initialize variables to track the largest font size and its location
     # Find the Largest Font Sized Text
     if debug:
@@ -261,7 +361,7 @@ class BidFileAnnotationService:
         if debug:
           print(ocr_result['text'][candidate])
           print(str(top) + ' ' + str(bordered_height))
-        if top < bordered_height * .5:
+        if top - border_size < crop_height * .5:
           continue
         font_size = ocr_result['height'][candidate]
         if font_size > max_size:
@@ -281,28 +381,19 @@ class BidFileAnnotationService:
       page_number_coordinates = self.extract_coordinates_from_ocr_result(
         ocr_result,
         page_number_index, 
-        border_size
+        border_size,
+        scale
       )
     return page_number_text, page_number_coordinates
   
-  def extract_page_number_from_roi(self, roi, psm=7, debug=False):
+  def extract_page_number_from_roi(self, roi, psm=7, debug=False, padding_mode=None):
     roi_gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
     # Apply a binary threshold to get a binary inverted image
     _, binary_inverted_image = cv2.threshold(roi_gray, 0, 255, cv2.THRESH_BINARY_INV)
-
-    # Get the dimensions of the image
-    _, width = binary_inverted_image.shape[:2]
-
-    kernel = np.ones((3, 3), np.uint8)
-    dilation = cv2.dilate(binary_inverted_image, kernel, iterations=1)
-    reverted_dilation = cv2.bitwise_not(dilation)
-
-    border_size = width
-    bordered_image = cv2.copyMakeBorder(reverted_dilation, border_size, border_size, border_size, border_size, cv2.BORDER_CONSTANT, value=[255, 255, 255])
+    bordered_image, border_size, scale = self.prepare_for_ocr(binary_inverted_image, padding_mode=padding_mode)
 
     # Perform OCR on the cropped image
-    custom_config = "--oem 1 --psm %s" % psm
-    ocr_result = pytesseract.image_to_data(Image.fromarray(bordered_image), output_type=pytesseract.Output.DICT, config=custom_config)
+    ocr_result = self.ocr_backend.image_to_data(bordered_image, psm)
     
     if debug:
       print(ocr_result)
@@ -310,6 +401,9 @@ class BidFileAnnotationService:
       cv2.waitKey(0)
       cv2.destroyAllWindows()
 
+    return self.parse_roi_ocr_result(ocr_result, border_size, scale)
+
+  def parse_roi_ocr_result(self, ocr_result, border_size, scale=1.0):
     if len(ocr_result['text']) == 0:
       return
     
@@ -338,7 +432,7 @@ class BidFileAnnotationService:
       page_number += fragment
     for idx in coords.keys():
       if coords[idx] is not None:
-        coords[idx] -= border_size
+        coords[idx] = int(round((coords[idx] - border_size) / scale))
     return page_number, coords
 
 
@@ -364,7 +458,7 @@ class BidFileAnnotationService:
     cv2.imshow(f'{title1} | {title2}', combined)
 
 
-  def identify_page_number_from_sidepanel(self, cv2_image, panel_coords, debug=False):
+  def identify_page_number_from_sidepanel(self, cv2_image, panel_coords, debug=False, padding_mode=None):
     sidepanel = cv2_image[panel_coords['y1']:panel_coords['y2'], panel_coords['x1']:panel_coords['x2']]
 
     if debug:
@@ -380,7 +474,7 @@ class BidFileAnnotationService:
     # Apply a binary threshold to get a binary inverted image
     _, binary_inverted_sidepanel = cv2.threshold(sidepanel_gray, 0, 255, cv2.THRESH_BINARY_INV)
 
-    page_number_text, page_number_coordinates = self.extract_page_number(binary_inverted_sidepanel, debug=debug)
+    page_number_text, page_number_coordinates = self.extract_page_number(binary_inverted_sidepanel, debug=debug, padding_mode=padding_mode)
     if page_number_coordinates:
       page_number_coordinates = {
         'x1': page_number_coordinates['x1'] + panel_coords['x1'],
@@ -390,7 +484,182 @@ class BidFileAnnotationService:
       }
     return page_number_text, page_number_coordinates
 
-  def identify_panels(self, cv2_image, debug=False):
+  def identify_panels(self, cv2_image, debug=False, mode=None):
+    if mode is None:
+      mode = settings.panel_detection_mode
+    if mode == 'hough':
+      return self.identify_panels_hough(cv2_image, debug=debug)
+    if mode == 'projection':
+      return self.identify_panels_projection(cv2_image, debug=debug)
+    if mode == 'coarse':
+      return self.identify_panels_coarse(cv2_image, debug=debug)
+    raise ValueError("Unknown panel detection mode %s" % mode)
+
+  def find_line_positions(self, profile, min_count):
+    # collapses each run of rows (or columns) with at least min_count ink pixels into its center
+    is_line = np.concatenate(([False], profile >= min_count, [False]))
+    edges = np.flatnonzero(is_line[1:] != is_line[:-1])
+    return [int((start + end - 1) // 2) for start, end in zip(edges[::2], edges[1::2])]
+
+  def count_ink(self, integral, x1, y1, x2, y2):
+    return int(integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1])
+
+  def is_mostly_empty(self, integral, x1, y1, x2, y2, block=1):
+    # integral may be of ink counts per block x block cell; coordinates are always full resolution
+    total_pixels = (x2 - x1) * (y2 - y1)
+    if block > 1:
+      rows, columns = integral.shape[0] - 1, integral.shape[1] - 1
+      x1, y1 = min(x1 // block, columns), min(y1 // block, rows)
+      x2, y2 = min(-(-x2 // block), columns), min(-(-y2 // block), rows)
+    return self.count_ink(integral, x1, y1, x2, y2) <= total_pixels * 0.001
+
+  def identify_panels_projection(self, cv2_image, debug=False):
+    # same idea as the hough path, but lines come from row/column ink projections and
+    # "is this band mostly empty" is an O(1) lookup in an integral image of the ink
+    panels = []
+    height, width = cv2_image.shape[:2]
+
+    gray = cv2.cvtColor(cv2_image, cv2.COLOR_BGR2GRAY)
+    _, binary_image = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV)
+    gray = None
+    integral = cv2.integral(binary_image // 255)
+
+    # horizontal lines span most of the width; a short horizontal dilation bridges small gaps
+    row_profile = np.count_nonzero(cv2.dilate(binary_image, np.ones((1, 10), np.uint8)), axis=1)
+    horizontal_lines = self.find_line_positions(row_profile, width * 0.8)
+    if debug:
+      print(horizontal_lines)
+    if len(horizontal_lines) == 0:
+      print("Could not extract horizontal lines")
+      return panels
+
+    top, bottom = self.bound_vertically(integral, horizontal_lines, width, height)
+    if debug:
+      print(top)
+      print(bottom)
+
+    column_profile = np.count_nonzero(cv2.dilate(binary_image[top:bottom, :], np.ones((10, 1), np.uint8)), axis=0)
+    vertical_lines = self.find_line_positions(column_profile, (bottom - top) * 0.8)
+    if debug:
+      print(vertical_lines)
+    if len(vertical_lines) == 0:
+      print("could not find vertical lines")
+      return panels
+
+    panels = self.panels_between_lines(integral, vertical_lines, top, bottom, width)
+    if debug:
+      self.display_panels(cv2_image, panels)
+    return panels
+
+  def bound_vertically(self, integral, horizontal_lines, width, height, block=1):
+    # the drawing area runs from the first to the last band between horizontal lines that has ink in it
+    top = None
+    bottom = None
+    for y1, y2 in zip(horizontal_lines, horizontal_lines[1:]):
+      if not self.is_mostly_empty(integral, 0, y1, width, y2, block):
+        if top is None:
+          top = y1
+        bottom = y2
+    if top is None:
+      top = 0
+      bottom = height - 1
+    return top, bottom
+
+  def panels_between_lines(self, integral, vertical_lines, top, bottom, width, block=1):
+    # Now we'll look for the regions between two vertical lines which aren't mostly empty
+    panels = []
+    for i, x1 in enumerate(vertical_lines):
+      x2 = vertical_lines[i + 1] if i < len(vertical_lines) - 1 else width
+      # ignore small regions ( < 5% of the width)
+      if (x2 - x1) < 0.05 * width:
+        continue
+      if not self.is_mostly_empty(integral, x1, top, x2, bottom, block):
+        panels.append({'x1': x1, 'x2': x2, 'y1': top, 'y2': bottom})
+    return panels
+
+  def display_panels(self, cv2_image, panels):
+    for panel in panels:
+      panel_image = cv2_image[panel['y1']:panel['y2'], panel['x1']:panel['x2']]
+      cv2.imshow('panel', panel_image)
+      cv2.waitKey(0)
+      cv2.destroyAllWindows()
+
+  def ink_mask(self, cv2_image):
+    # 255 where the sheet is pure black, the same pixels threshold(gray, 0, 255, THRESH_BINARY_INV) marks
+    if cv2_image.ndim == 2:
+      return cv2.inRange(cv2_image, 0, 0)
+    return cv2.inRange(cv2_image, (0, 0, 0), (0, 0, 0))
+
+  def refine_line_positions(self, coarse_positions, window_profile, block, length):
+    # snaps each coarse line to the strongest full resolution row/column within one coarse cell of it.
+    # window_profile(start, end) returns the ink count of every row/column in [start, end)
+    refined = set()
+    for position in coarse_positions:
+      start = max((position - 1) * block, 0)
+      end = min((position + 2) * block, length)
+      if end <= start:
+        continue
+      refined.add(start + int(np.argmax(window_profile(start, end))))
+    return sorted(refined)
+
+  def identify_panels_coarse(self, cv2_image, debug=False, scale=None):
+    # the sheet is reduced to ink counts per block x block cell in one pass. Lines are found and the
+    # emptiness checks run on that coarse map; only the few rows/columns around each chosen line are
+    # looked at again at full resolution
+    if scale is None:
+      scale = settings.panel_detection_scale
+    block = max(int(round(1 / scale)), 1)
+    panels = []
+    height, width = cv2_image.shape[:2]
+    small_height = max(height // block, 1)
+    small_width = max(width // block, 1)
+
+    ink_counts = self.ink_mask(cv2_image[:small_height * block, :small_width * block]) \
+      .reshape(small_height, block, small_width, block) \
+      .sum(axis=(1, 3), dtype=np.int32) // 255
+    integral = np.zeros((small_height + 1, small_width + 1), dtype=np.int64)
+    integral[1:, 1:] = ink_counts.cumsum(axis=0).cumsum(axis=1)
+    # any ink in a cell marks it, which stands in for the dilation
+    small_ink = ink_counts > 0
+
+    def row_profile(start, end):
+      return np.count_nonzero(self.ink_mask(cv2_image[start:end, :]), axis=1)
+
+    coarse_rows = self.find_line_positions(np.count_nonzero(small_ink, axis=1), small_width * 0.8)
+    horizontal_lines = self.refine_line_positions(coarse_rows, row_profile, block, height)
+    if debug:
+      print(horizontal_lines)
+    if len(horizontal_lines) == 0:
+      print("Could not extract horizontal lines")
+      return panels
+
+    top, bottom = self.bound_vertically(integral, horizontal_lines, width, height, block)
+    if debug:
+      print(top)
+      print(bottom)
+
+    def column_profile(start, end):
+      return np.count_nonzero(self.ink_mask(cv2_image[top:bottom, start:end]), axis=0)
+
+    small_top = top // block
+    small_bottom = max(bottom // block, small_top + 1)
+    coarse_columns = self.find_line_positions(
+      np.count_nonzero(small_ink[small_top:small_bottom, :], axis=0),
+      (small_bottom - small_top) * 0.8
+    )
+    vertical_lines = self.refine_line_positions(coarse_columns, column_profile, block, width)
+    if debug:
+      print(vertical_lines)
+    if len(vertical_lines) == 0:
+      print("could not find vertical lines")
+      return panels
+
+    panels = self.panels_between_lines(integral, vertical_lines, top, bottom, width, block)
+    if debug:
+      self.display_panels(cv2_image, panels)
+    return panels
+
+  def identify_panels_hough(self, cv2_image, debug=False):
     panels = []
     height, width = cv2_image.shape[:2]
 
@@ -559,25 +828,33 @@ class BidFileAnnotationService:
     annotations = await db.UniqueImageAnnotation.objects.filter(unique_image_id=bid_file_image.id).all()
     if len(annotations) > 0 and not force:
       return
-    annotation = db.UniqueImageAnnotation.construct(unique_image_id=bid_file_image.id)
 
-    cv2_image = cv2.imread(bid_file_image.local_filename, cv2.IMREAD_COLOR)
+    cv2_image = cv2.imread(resolve(bid_file_image.local_filename), cv2.IMREAD_COLOR)
+    page_number_text, page_number_coordinates = self.detect_page_number(cv2_image)
+    if page_number_text:
+      annotation = self.build_page_number_annotation(bid_file_image.id, page_number_text, page_number_coordinates)
+      await annotation.save()
+      return annotation
+
+  def detect_page_number(self, cv2_image):
+    # the cpu bound half of annotate_page_number, safe to run in a worker process
     panels = self.identify_panels(cv2_image)
     if len(panels) < 2:
       print("Could not find sidepanels")
-      return None
+      return None, None
 
     sidepanel = panels[-1]
-    page_number_text, page_number_coordinates = self.identify_page_number_from_sidepanel(cv2_image, sidepanel)
-    if page_number_text:
-      annotation.page_number = page_number_text
-      annotation.page_number_x1 = page_number_coordinates['x1']
-      annotation.page_number_x2 = page_number_coordinates['x2']
-      annotation.page_number_y1 = page_number_coordinates['y1']
-      annotation.page_number_y2 = page_number_coordinates['y2']
-      annotation.annotation_source = db.AnnotationSource.HEURISTICS.value
-      await annotation.save()
-      return annotation
+    return self.identify_page_number_from_sidepanel(cv2_image, sidepanel)
+
+  def build_page_number_annotation(self, unique_image_id, page_number_text, page_number_coordinates):
+    annotation = db.UniqueImageAnnotation.construct(unique_image_id=unique_image_id)
+    annotation.page_number = page_number_text
+    annotation.page_number_x1 = page_number_coordinates['x1']
+    annotation.page_number_x2 = page_number_coordinates['x2']
+    annotation.page_number_y1 = page_number_coordinates['y1']
+    annotation.page_number_y2 = page_number_coordinates['y2']
+    annotation.annotation_source = db.AnnotationSource.HEURISTICS.value
+    return annotation
 
 
   async def manually_annotate_page_number(self, bid_file_image, panel_coords=None, force=False, use_panels=True):
@@ -590,7 +867,7 @@ class BidFileAnnotationService:
     annotation = db.UniqueImageAnnotation.construct(unique_image_id=bid_file_image.id)
     print("manually annotating %s" % bid_file_image.local_filename)
 
-    cv2_image = cv2.imread(bid_file_image.local_filename, cv2.IMREAD_COLOR)
+    cv2_image = cv2.imread(resolve(bid_file_image.local_filename), cv2.IMREAD_COLOR)
     if panel_coords is None:
       panel_coords = {
         'x1': 0,
@@ -608,6 +885,8 @@ class BidFileAnnotationService:
     else:
       used_panels = True
 
+    from PyQt5.QtWidgets import QApplication
+    from app.services.bounding_box_app import BoundingBoxApp
     app = QApplication([])
     viewer = BoundingBoxApp(cv2_image[panel_coords['y1']:panel_coords['y2'], panel_coords['x1']:panel_coords['x2']])
     viewer.show()
@@ -637,7 +916,7 @@ class BidFileAnnotationService:
       return
 
     bid_file_image = await db.UniqueImage.objects.get(id=annotation.unique_image_id)
-    cv2_image = cv2.imread(bid_file_image.local_filename, cv2.IMREAD_COLOR)
+    cv2_image = cv2.imread(resolve(bid_file_image.local_filename), cv2.IMREAD_COLOR)
     page_number_image = cv2_image[annotation.page_number_y1:annotation.page_number_y2, annotation.page_number_x1:annotation.page_number_x2]
     self.display_images_side_by_side(cv2_image, "Original", page_number_image, annotation.page_number)
     key = cv2.waitKey(0)
@@ -650,3 +929,18 @@ class BidFileAnnotationService:
       annotation.valid_roi = None
     await annotation.update()
     return annotation
+
+# each annotation worker process keeps its own service (and with it its ocr engine) around
+# between images instead of rebuilding it per task
+worker_annotation_service = None
+
+def init_annotation_worker():
+  global worker_annotation_service
+  worker_annotation_service = BidFileAnnotationService(None)
+
+def detect_page_number_in_worker(unique_image_id, local_filename):
+  cv2_image = cv2.imread(resolve(local_filename), cv2.IMREAD_COLOR)
+  if cv2_image is None:
+    raise ValueError("Could not read %s" % local_filename)
+  page_number_text, page_number_coordinates = worker_annotation_service.detect_page_number(cv2_image)
+  return unique_image_id, page_number_text, page_number_coordinates
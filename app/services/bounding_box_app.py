@@ -0,0 +1,93 @@
+# the Qt review ui, kept out of bid_file_annotation_service so headless workers never load PyQt5
+from PyQt5.QtWidgets import QLabel, QWidget, QVBoxLayout
+from PyQt5.QtGui import QPixmap, QPainter, QPen, QImage
+from PyQt5.QtCore import Qt, QPoint, QTimer, QRect
+
+class BoundingBoxApp(QWidget):
+  def __init__(self, imageArray):
+    super().__init__()
+    self.imageArray = imageArray
+    self.initUI()
+
+  def initUI(self):
+    self.setWindowTitle("Bounding Box Drawer")
+    self.setGeometry(100, 100, 1200, 900)
+
+    self.layout = QVBoxLayout()
+    self.imageLabel = QLabel(self)
+    self.imageLabel.setAlignment(Qt.AlignCenter)
+    self.layout.addWidget(self.imageLabel)
+    self.setLayout(self.layout)
+    QTimer.singleShot(100, self.loadImage)  # Load image after everything is initialized
+
+  def loadImage(self):
+    height, width, channel = self.imageArray.shape
+    bytesPerLine = 3 * width
+    qImg = QImage(self.imageArray.tobytes(), width, height, bytesPerLine, QImage.Format_RGB888).rgbSwapped()
+    self.pixmap = QPixmap.fromImage(qImg)
+    self.scaledPixmap = self.pixmap.scaled(self.imageLabel.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    # Calculate scale factors
+    self.scaleW = self.pixmap.width() / self.scaledPixmap.width()
+    self.scaleH = self.pixmap.height() / self.scaledPixmap.height()
+
+    self.imageLabel.setPixmap(self.scaledPixmap)
+    self.imageLabel.setContentsMargins(0, 0, 0, 0)  # No margins
+    self.imageLabel.setAlignment(Qt.AlignTop | Qt.AlignLeft)  # Align to the top left
+
+    # Initializing drawing state
+    self.startPoint = QPoint()
+    self.endPoint = QPoint()
+    self.drawing = False
+
+    # Connect mouse events
+    self.imageLabel.mousePressEvent = self.mousePressEvent
+    self.imageLabel.mouseMoveEvent = self.mouseMoveEvent
+    self.imageLabel.mouseReleaseEvent = self.mouseReleaseEvent
+
+    self.cancelled = False
+
+  def getBoundingBoxCoords(self):
+    if self.cancelled:
+      return None
+    origX1 = int(min([self.startPoint.x(), self.endPoint.x()]) * self.scaleW)
+    origY1 = int(min([self.startPoint.y(), self.endPoint.y()]) * self.scaleH)
+    origX2 = int(max([self.startPoint.x(), self.endPoint.x()]) * self.scaleW)
+    origY2 = int(max([self.startPoint.y(), self.endPoint.y()]) * self.scaleH)
+    print(self.scaleH)
+    print(self.startPoint.y())
+    return (origX1, origY1, origX2, origY2)
+
+  def mousePressEvent(self, event):
+    if event.button() == Qt.LeftButton:
+      self.drawing = True
+      self.startPoint = event.pos()
+      self.endPoint = event.pos()
+
+  def mouseMoveEvent(self, event):
+    if event.buttons() & Qt.LeftButton and self.drawing:
+      self.endPoint = event.pos()
+      self.updateDrawing()
+
+  def mouseReleaseEvent(self, event):
+    if event.button() == Qt.LeftButton:
+      self.drawing = False
+      self.endPoint = event.pos()
+      self.updateDrawing()
+
+  def keyPressEvent(self, event):
+    key = event.key()
+    if key in (Qt.Key_Escape, Qt.Key_Return, Qt.Key_Enter):
+      if key == Qt.Key_Escape:
+        self.cancelled = True
+      self.close()
+
+  def updateDrawing(self):
+    tempPixmap = self.scaledPixmap.copy()
+    painter = QPainter(tempPixmap)
+    pen = QPen(Qt.red, 2, Qt.SolidLine)
+    painter.setPen(pen)
+    rect = QRect(self.startPoint, self.endPoint)
+    painter.drawRect(rect)
+    painter.end()
+    self.imageLabel.setPixmap(tempPixmap)
@@ -1,39 +1,92 @@
-import requests
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import re
+import uuid
+from urllib.parse import urlparse
+
+import httpx
+import sqlalchemy
 from databases import Database
 from dateutil import parser
-from pathlib import Path
+from sqlalchemy.dialects.postgresql import insert
 
 from app.config import settings
 from app import db
+from app.storage import bid_file_key, get_storage
 
 import magic
 
 
+def parse_date(value):
+  return parser.parse(value).replace(tzinfo=None) if value is not None else None
+
+async def gather_or_cancel(*aws):
+  # like asyncio.gather, but when one of them raises the others are cancelled and awaited before the
+  # error propagates, so nothing is left using the http session or the database after it's closed
+  tasks = [asyncio.ensure_future(aw) for aw in aws]
+  try:
+    return await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    raise
+
 class BuildingConnectedDataService:
   LOGIN_URL = 'https://app.buildingconnected.com/login'
   EMAIL_API_ENDPOINT = 'https://app.buildingconnected.com/api/sso/status/login'
   LOGIN_API_ENDPOINT = 'https://app.buildingconnected.com/api/sessions'
   OPPORTUNITIES_API_ENDPONT = 'https://app.buildingconnected.com/api/opportunities/v2/pipeline'
-  LOCAL_FILENAME_PATH = '/Users/harish/data/bidboard' 
+  BID_PAGE_SIZE = 50
+  MIN_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+  MAX_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
  
-  def __init__(self, db: Database, company: db.Company):
+  def __init__(self, db: Database, company: db.Company, concurrency=None):
     self.db = db
     self.company = company
     self.session = None
+    self.concurrency = concurrency if concurrency is not None else settings.bc_concurrency
+    self.request_semaphore = None
+    self.company_lock = asyncio.Lock()
+    self.download_semaphore = None
+    self.host_download_semaphores = {}
+    self.incremental = False
+    self.watermark = None
+    self.max_date_invited = None
     self.mime = magic.Magic(mime=True)
 
   
-  def init_session(self):
-    self.session = requests.Session()
-    self.session.get(BuildingConnectedDataService.LOGIN_URL)
-    self.session.get(
+  async def init_session(self):
+    self.request_semaphore = asyncio.Semaphore(self.concurrency)
+    self.download_semaphore = asyncio.Semaphore(settings.bc_download_concurrency)
+    self.host_download_semaphores = {}
+    max_connections = self.concurrency + settings.bc_download_concurrency
+    self.session = httpx.AsyncClient(
+      limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+      timeout=httpx.Timeout(60.0),
+      follow_redirects=True
+    )
+    await self.session.get(BuildingConnectedDataService.LOGIN_URL)
+    await self.session.get(
       BuildingConnectedDataService.EMAIL_API_ENDPOINT,
       params={ 'email': settings.building_connected_username }
     )
-    self.authenticate()
+    await self.authenticate()
+
+  async def close_session(self):
+    if self.session is not None:
+      await self.session.aclose()
+      self.session = None
+
+  async def get(self, url, **kwargs):
+    async with self.request_semaphore:
+      return await self.session.get(url, **kwargs)
 
-  def authenticate(self):
-    response = self.session.post(
+  async def authenticate(self):
+    response = await self.session.post(
       BuildingConnectedDataService.LOGIN_API_ENDPOINT,
       data={
         'grant_type': 'password',
@@ -43,23 +96,25 @@ class BuildingConnectedDataService:
     )
 
   async def upsert_company(self, company_dict):
-    client = await db.BCCompany.objects.get_or_none(bc_id=company_dict['_id'])
-    if client is None:
-      client = await db.BCCompany(
-        bc_id=company_dict['_id'],
-        name=company_dict['name'],
-        data=company_dict
-      ).save()
+    # bids are synced concurrently and many of them share a client company
+    async with self.company_lock:
+      client = await db.BCCompany.objects.get_or_none(bc_id=company_dict['_id'])
+      if client is None:
+        client = await db.BCCompany(
+          bc_id=company_dict['_id'],
+          name=company_dict['name'],
+          data=company_dict
+        ).save()
     return client
 
   async def upsert_bid(self, bid_dict):
-    created = True
+    exists = True
     bid = await db.BCBid.objects.get_or_none(
       company_id=self.company.id,
       bc_id=bid_dict['_id']
     )
     if bid is None:
-      created = False
+      exists = False
       bid = db.BCBid.construct(company_id=self.company.id, bc_id=bid_dict['_id'])
     bid.data = bid_dict
     bc_company = await self.upsert_company(bid_dict['client']['company'])
@@ -70,108 +125,341 @@ class BuildingConnectedDataService:
     bid.date_invited = parser.parse(bid_dict['dateInvited']).replace(tzinfo=None) if bid_dict.get('dateInvited') else None
     bid.is_archived = bid_dict['isArchived']
     bid.status = db.BCBidStatus[bid_dict['workflowState']].value
-    if created is False:
+    previous_date_modified = bid.date_modified
+    bid.date_modified = parse_date(bid_dict.get('dateModified', None))
+    if exists is False:
       await bid.save()
     else:
       await bid.update()
-    
-    await self.sync_bid_files(bid)
+
+    if bid.date_invited is not None and (self.max_date_invited is None or bid.date_invited > self.max_date_invited):
+      self.max_date_invited = bid.date_invited
+
+    # an untouched bid still has its tree listed, but is only written if the tree's hash changed
+    known_files_hash = None
+    if self.incremental and exists and bid.date_modified is not None and bid.date_modified == previous_date_modified:
+      known_files_hash = bid.files_hash
+    files_hash = await self.sync_bid_files(bid, known_files_hash=known_files_hash)
+    if files_hash is not None and files_hash != bid.files_hash:
+      await bid.update(files_hash=files_hash)
 
     return bid
 
+  def get_host_download_semaphore(self, url):
+    # keyed on the host that actually serves the bytes, download urls all redirect off app.buildingconnected.com
+    host = urlparse(str(url)).netloc
+    if host not in self.host_download_semaphores:
+      self.host_download_semaphores[host] = asyncio.Semaphore(settings.bc_downloads_per_host)
+    return self.host_download_semaphores[host]
+
+  def parse_retry_after(self, retry_after):
+    try:
+      return min(max(int(retry_after), 0), 300)
+    except (TypeError, ValueError):
+      return None
+
+  def get_download_chunk_size(self, total_size):
+    # aim for roughly a hundred writes per file, within sane bounds
+    if total_size is None:
+      return BuildingConnectedDataService.MAX_DOWNLOAD_CHUNK_SIZE
+    return min(
+      max(total_size // 100, BuildingConnectedDataService.MIN_DOWNLOAD_CHUNK_SIZE),
+      BuildingConnectedDataService.MAX_DOWNLOAD_CHUNK_SIZE
+    )
+
+  def parse_content_range_total(self, content_range):
+    match = re.match(r'^bytes (?:\d+-\d+|\*)/(\d+)$', content_range or '')
+    return int(match.group(1)) if match else None
+
+  def file_md5(self, filename):
+    hasher = hashlib.md5()
+    with open(filename, 'rb') as file:
+      for chunk in iter(lambda: file.read(BuildingConnectedDataService.MAX_DOWNLOAD_CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+  async def verify_download(self, part_filename, total_size, etag):
+    size = os.path.getsize(part_filename)
+    if total_size is not None and size != total_size:
+      print(f"Size mismatch for {part_filename}: expected {total_size}, got {size}")
+      return False
+    # single part S3 style etags are the md5 of the content
+    etag = (etag or '').strip('"')
+    if re.match(r'^[0-9a-f]{32}$', etag):
+      md5_hash = await asyncio.to_thread(self.file_md5, part_filename)
+      if md5_hash != etag:
+        print(f"Checksum mismatch for {part_filename}: expected {etag}, got {md5_hash}")
+        return False
+    return True
+
+  async def download_file(self, url, local_filename):
+    # bytes land in a .part file that survives interruptions. Retries resume it with a Range
+    # request guarded by If-Range, and it is only renamed into place once verified
+    part_filename = '%s.part' % local_filename
+    etag_filename = '%s.etag' % part_filename
+    retry_delay = None
+    for attempt in range(settings.bc_download_retries + 1):
+      if attempt > 0:
+        await asyncio.sleep(retry_delay if retry_delay is not None else min(2 ** attempt, 60))
+        retry_delay = None
+      offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+      etag = None
+      if os.path.exists(etag_filename):
+        with open(etag_filename) as file:
+          etag = file.read().strip() or None
+      # the bytes are stored exactly as served, so they match content-length and the etag
+      headers = {'Accept-Encoding': 'identity'}
+      if offset > 0:
+        headers['Range'] = 'bytes=%s-' % offset
+        if etag is not None:
+          headers['If-Range'] = etag
+
+      try:
+        async with self.download_semaphore:
+          async with self.session.stream('GET', url, headers=headers) as response:
+            if response.status_code == 429 or response.status_code >= 500:
+              retry_delay = self.parse_retry_after(response.headers.get('retry-after'))
+              print(f"Got {response.status_code} downloading {url}, attempt {attempt + 1}")
+              continue
+            if response.status_code == 206:
+              mode = 'ab'
+              total_size = self.parse_content_range_total(response.headers.get('content-range'))
+            elif response.status_code == 200:
+              # no resume support or the file changed under us, start over
+              mode = 'wb'
+              total_size = int(response.headers['content-length']) if 'content-length' in response.headers else None
+            elif response.status_code == 416:
+              total_size = self.parse_content_range_total(response.headers.get('content-range'))
+              if total_size != offset:
+                os.remove(part_filename)
+                continue
+              mode = None
+            else:
+              print(f"Failed to download {url}. Status code: {response.status_code}")
+              return None
+
+            if response.headers.get('etag'):
+              etag = response.headers['etag']
+              with open(etag_filename, 'w') as file:
+                file.write(etag)
+            if mode is not None:
+              async with self.get_host_download_semaphore(response.url):
+                with open(part_filename, mode) as file:
+                  # raw, so a content-encoding isn't decoded into bytes that no longer match
+                  async for chunk in response.aiter_raw(chunk_size=self.get_download_chunk_size(total_size)):
+                    file.write(chunk)
+      except httpx.TransportError as e:
+        print(f"Interrupted downloading {url} ({e!r}), attempt {attempt + 1}")
+        continue
+
+      if not await self.verify_download(part_filename, total_size, etag):
+        os.remove(part_filename)
+        continue
+      os.replace(part_filename, local_filename)
+      if os.path.exists(etag_filename):
+        os.remove(etag_filename)
+      return local_filename
+
+    print(f"Giving up on {url} after {settings.bc_download_retries + 1} attempts")
+    return None
+
   async def cache_bid_file(self, bid_file, force=False):
     if bid_file.local_filename is not None and not force:
       return bid_file
 
-    output_folder = "%s/%s" % (BuildingConnectedDataService.LOCAL_FILENAME_PATH, bid_file.id)
-    Path(output_folder).mkdir(parents=True, exist_ok=True)
+    if bid_file.download_url is None:
+      return
 
-    local_filename = "%s/source_file" % output_folder
+    storage = get_storage()
+    key = bid_file_key(bid_file.id)
+    local_filename = storage.staging_path(key)
 
     # Stream the download to handle large files without consuming too much memory
-    response = self.session.get("https://app.buildingconnected.com/%s" % bid_file.download_url, stream=True)
-    # Check if the request was successful
-    if response.status_code == 200:
-      with open(local_filename, 'wb') as file:
-        for chunk in response.iter_content(chunk_size=8192):  # 8K chunks
-          file.write(chunk)
-    else:
-      print(f"Failed to download bid file {bid_file.id} from {bid_file.download_url}. Status code: {response.status_code}")
+    if await self.download_file("https://app.buildingconnected.com/%s" % bid_file.download_url, local_filename) is None:
+      print(f"Failed to download bid file {bid_file.id} from {bid_file.download_url}")
       return
+    await asyncio.to_thread(storage.commit, key)
 
-    bid_file.local_filename = local_filename
+    bid_file.local_filename = key
     bid_file.mime_type = self.mime.from_file(local_filename)
     await bid_file.update()
     return bid_file
+
+  async def cache_bid_files(self, bid_files, force=False):
+    # concurrency is bounded by the download semaphores
+    return await asyncio.gather(*[self.cache_bid_file(bid_file, force=force) for bid_file in bid_files])
   
-  async def upsert_bid_file(self, bid, file_dict, parent_folder=None):
-    created = True
-    file = await db.BCBidFile.objects.get_or_none(
-      bc_bid_id=bid.id,
-      bc_id=file_dict['_id']
-    )
-    if file is None:
-      created = False
-      file = db.BCBidFile.construct(bc_bid_id=bid.id, bc_id=file_dict['_id'])
-    file.data = file_dict
-    file.name = file_dict['name']
-    file.file_system_type = db.BCBidFileSystemType[file_dict['type']].value
-    file.download_url = file_dict['downloadUrl'] if 'downloadUrl' in file_dict.keys() else None
-    file.date_created = parser.parse(file_dict['dateCreated']).replace(tzinfo=None) if file_dict.get('dateCreated', None) is not None else None
-    file.date_modified = parser.parse(file_dict['dateModified']).replace(tzinfo=None) if file_dict.get('dateModified', None) is not None else None
-    if parent_folder is not None:
-      file.parent_folder_id = str(parent_folder.id)
-    if created is False:
-      await file.save()
-    else:
-      await file.update()
-    return file
-
-  async def sync_bid_files(self, bid, parent_folder=None):
-    bc_id = bid.bc_id
-    endpoint = "https://app.buildingconnected.com/api/opportunities/%s/files" % bc_id
-    if parent_folder is not None:
-      endpoint += '/%s' % parent_folder.bc_id
-    response = self.session.get(endpoint)
+  async def bulk_upsert_bid_files(self, bid, items, chunk_size=500):
+    # items is a list of (file_dict, parent_folder_id) pairs, written in chunks of chunk_size rows
+    # inside one transaction so a single statement stays well under postgres' 32767 bind parameters;
+    # returns a map from bc_id to the id of the bid file row
+    now = datetime.datetime.utcnow()
+    bid_files = db.BCBidFile.Meta.table
+    rows = {}
+    for file_dict, parent_folder_id in items:
+      rows[file_dict['_id']] = {
+        'id': uuid.uuid4(),
+        'created_at': now,
+        'bc_bid_id': bid.id,
+        'bc_id': file_dict['_id'],
+        'data': file_dict,
+        'name': file_dict['name'],
+        'file_system_type': db.BCBidFileSystemType[file_dict['type']].value,
+        'download_url': file_dict['downloadUrl'] if 'downloadUrl' in file_dict.keys() else None,
+        'date_created': parse_date(file_dict.get('dateCreated', None)),
+        'date_modified': parse_date(file_dict.get('dateModified', None)),
+        'parent_folder_id': str(parent_folder_id) if parent_folder_id is not None else None,
+        'images_extracted': False
+      }
+    bc_ids = sorted(rows.keys())
+
+    updated_columns = ['data', 'name', 'file_system_type', 'download_url', 'date_created', 'date_modified']
+    ids = {}
+    async with self.db.transaction():
+      for i in range(0, len(bc_ids), chunk_size):
+        chunk = bc_ids[i:i + chunk_size]
+        insert_bid_files = insert(bid_files).values([rows[bc_id] for bc_id in chunk])
+        set_ = {column: insert_bid_files.excluded[column] for column in updated_columns}
+        # top level items don't carry a parent, so leave whatever was there before
+        set_['parent_folder_id'] = sqlalchemy.func.coalesce(insert_bid_files.excluded.parent_folder_id, bid_files.c.parent_folder_id)
+        set_['updated_at'] = now
+        await self.db.execute(
+          insert_bid_files.on_conflict_do_update(index_elements=['bc_bid_id', 'bc_id'], set_=set_)
+        )
+        id_rows = await self.db.fetch_all(
+          sqlalchemy.select([bid_files.c.id, bid_files.c.bc_id])
+            .where(bid_files.c.bc_bid_id == bid.id)
+            .where(bid_files.c.bc_id.in_(chunk))
+        )
+        ids.update({row['bc_id']: row['id'] for row in id_rows})
+    return ids
+
+  async def list_bid_folder(self, bid, folder_bc_id=None):
+    endpoint = "https://app.buildingconnected.com/api/opportunities/%s/files" % bid.bc_id
+    if folder_bc_id is not None:
+      endpoint += '/%s' % folder_bc_id
+    response = await self.get(endpoint)
     if response.status_code == 403:
-      return
+      return []
     try:
-      items = response.json()['items']
+      return response.json()['items']
     except KeyError:
       print(response.json())
-      return
-    for item in items:
+      return []
+
+  def hash_file_tree(self, levels):
+    # levels holds every level of the crawl, each a list of (file_dict, parent folder bc_id) pairs
+    tree = sorted([
+      (parent_bc_id or '', item['_id'], item['name'], item.get('dateModified'))
+      for items in levels
+      for item, parent_bc_id in items
+    ])
+    return hashlib.sha256(json.dumps(tree).encode()).hexdigest()
+
+  async def list_bid_tree(self, bid, folder_bc_id=None):
+    # breadth first: every folder on a level is listed concurrently (bounded by the request semaphore).
+    # Returns the levels of the tree, each a list of (file_dict, parent folder bc_id) pairs
+    levels = []
+    level = [folder_bc_id]
+    while len(level) > 0:
+      listings = await asyncio.gather(*[self.list_bid_folder(bid, bc_id) for bc_id in level])
+      items = [
+        (item, bc_id)
+        for bc_id, folder_items in zip(level, listings)
+        for item in folder_items
+      ]
+      if len(items) == 0:
+        break
+      levels.append(items)
+      level = [item['_id'] for item, _ in items if item['type'] == 'FOLDER']
+    return levels
+
+  async def sync_bid_files(self, bid, parent_folder=None, known_files_hash=None):
+    # the whole tree is listed before anything is written, and when it hashes to known_files_hash
+    # nothing is written at all. Otherwise each level is upserted in one batch.
+    # Returns the hash of the whole tree when crawling from the root
+    levels = await self.list_bid_tree(bid, parent_folder.bc_id if parent_folder is not None else None)
+    files_hash = None
+    if parent_folder is None:
+      files_hash = self.hash_file_tree(levels)
+      if files_hash == known_files_hash:
+        return files_hash
+    folder_ids = {parent_folder.bc_id: parent_folder.id} if parent_folder is not None else {None: None}
+    for items in levels:
+      items = [(item, folder_ids[parent_bc_id]) for item, parent_bc_id in items]
       try:
-        file = await self.upsert_bid_file(bid, item, parent_folder)
+        file_ids = await self.bulk_upsert_bid_files(bid, items)
       except:
-        print(item)
+        print(items)
         raise
-      if item['type'] == 'FOLDER':
-        await self.sync_bid_files(bid, file)
-
-  async def sync_bids(self):
-    self.init_session()
-    for archive_state in ['ARCHIVED_ONLY', 'ACTIVE_ONLY']:
-      for workflow_state in db.BCBidStatus:
-        startIndex = 0
-        while True:
-          print("Syncing %s - %s bids, index %s" % (archive_state, workflow_state, startIndex))
-          response = self.session.get(BuildingConnectedDataService.OPPORTUNITIES_API_ENDPONT, params={
-            'startIndex': startIndex,
-            'count': 50,
-            'order': 'desc',
-            'userFilter': 'IM_FOLLOWING',
-            'workflowStates[]': workflow_state.name,
-            'sortKey': 'DATE_INVITED',
-            'archiveFilter': archive_state
-          })
-          results = response.json()['results']
-          if len(results) == 0:
-            break
-          for bid in results:
-            bid_row = await self.upsert_bid(bid)
-          startIndex += len(results)
+      folder_ids = {item['_id']: file_ids[item['_id']] for item, _ in items if item['type'] == 'FOLDER'}
+    return files_hash
+
+  async def fetch_bid_page(self, archive_state, workflow_state, start_index):
+    print("Syncing %s - %s bids, index %s" % (archive_state, workflow_state, start_index))
+    response = await self.get(BuildingConnectedDataService.OPPORTUNITIES_API_ENDPONT, params={
+      'startIndex': start_index,
+      'count': BuildingConnectedDataService.BID_PAGE_SIZE,
+      'order': 'desc',
+      'userFilter': 'IM_FOLLOWING',
+      'workflowStates[]': workflow_state.name,
+      'sortKey': 'DATE_INVITED',
+      'archiveFilter': archive_state
+    })
+    return response.json()['results']
+
+  async def sync_bid_partition(self, archive_state, workflow_state):
+    page_size = BuildingConnectedDataService.BID_PAGE_SIZE
+    start_index = 0
+    while True:
+      # fetch the next few pages of the partition at once rather than one after another
+      start_indexes = [start_index + i * page_size for i in range(settings.bc_prefetch_pages)]
+      pages = await gather_or_cancel(*[
+        self.fetch_bid_page(archive_state, workflow_state, page_start) for page_start in start_indexes
+      ])
+      for page_start, results in zip(start_indexes, pages):
+        if len(results) == 0:
+          return
+        await gather_or_cancel(*[self.upsert_bid(bid) for bid in results])
+        if self.is_behind_watermark(results[-1]):
+          # results are sorted by DATE_INVITED, so everything after this page was already synced
+          return
+        if len(results) < page_size:
+          # a short page means the speculative offsets after it are off, resume right after it
+          start_index = page_start + len(results)
+          break
+      else:
+        start_index = start_indexes[-1] + page_size
+
+  def is_behind_watermark(self, bid_dict):
+    if not self.incremental or self.watermark is None or not bid_dict.get('dateInvited'):
+      return False
+    return parse_date(bid_dict['dateInvited']) < self.watermark
+
+  async def sync_bids(self, incremental=False):
+    self.incremental = incremental
+    self.max_date_invited = None
+    watermark = await db.BCSyncWatermark.objects.get_or_none(company_id=self.company.id)
+    self.watermark = watermark.date_invited if watermark is not None and incremental else None
+
+    await self.init_session()
+    try:
+      await gather_or_cancel(*[
+        self.sync_bid_partition(archive_state, workflow_state)
+        for archive_state in ['ARCHIVED_ONLY', 'ACTIVE_ONLY']
+        for workflow_state in db.BCBidStatus
+      ])
+    finally:
+      await self.close_session()
+
+    # only advance the watermark once every partition has been synced past it
+    if self.max_date_invited is None:
+      return
+    if watermark is None:
+      await db.BCSyncWatermark(company_id=self.company.id, date_invited=self.max_date_invited).save()
+    elif watermark.date_invited is None or self.max_date_invited > watermark.date_invited:
+      await watermark.update(date_invited=self.max_date_invited)
 
   async def parse_bids(self):
-    for building_connected_bid in await db.BCBid.objects.filter(company_id=self.company.id).all():
+    async for building_connected_bid in db.BCBid.process_in_batches(100, fields=['data'], company_id=self.company.id):
       await self.upsert_bid(building_connected_bid.data)
@@ -0,0 +1,70 @@
+import math
+import os
+
+from app.config import settings
+from app.services.prediction_cache_service import hash_model_files
+
+class DrawingDetectorService:
+  MODEL_ID = 'sheet_number_yolov8'
+  # bump when the images handed to detect() change (colour handling, resizing)
+  PREPROCESSING_VERSION = 'bgr_1280_v1'
+  MODEL_DIRECTORY = '/Users/harish/data/bidboard_training_data/drawing_number_yolov8'
+  DATASET_CONFIG_PATH = os.path.join(MODEL_DIRECTORY, 'sheet_drawing_yolov8.yaml')
+  # the sheet number model is trained at 1280 in train_sheet_drawing_number_identifier
+  IMAGE_SIZE = 1280
+  # ultralytics names its exports after the source weights
+  MODEL_PATHS = {
+    'pytorch': os.path.join(MODEL_DIRECTORY, 'inference.pt'),
+    'onnx': os.path.join(MODEL_DIRECTORY, 'inference.onnx'),
+    'openvino': os.path.join(MODEL_DIRECTORY, 'inference_openvino_model'),
+    'openvino_int8': os.path.join(MODEL_DIRECTORY, 'inference_int8_openvino_model')
+  }
+
+  def __init__(self, backend=None):
+    self.backend = backend if backend is not None else settings.detector_backend
+    if self.backend not in DrawingDetectorService.MODEL_PATHS:
+      raise ValueError("Unknown detector backend %s" % self.backend)
+    self.model = None
+    self._model_version = None
+
+  def model_version(self):
+    if self._model_version is None:
+      self._model_version = hash_model_files(DrawingDetectorService.MODEL_PATHS[self.backend])
+    return self._model_version
+
+  def load(self):
+    from ultralytics import YOLO
+    # exported models run through onnxruntime/openvino behind the same YOLO interface
+    self.model = YOLO(DrawingDetectorService.MODEL_PATHS[self.backend], task='detect')
+    return self
+
+  def detect(self, images):
+    # returns a list of (x1, y1, x2, y2, confidence) boxes for every image
+    if self.model is None:
+      self.load()
+    results = self.model(images, imgsz=DrawingDetectorService.IMAGE_SIZE, verbose=False)
+    detections = []
+    for result in results:
+      detections.append([
+        (math.floor(x1), math.floor(y1), math.floor(x2), math.floor(y2), confidence)
+        for (x1, y1, x2, y2), confidence in zip(result.boxes.xyxy.tolist(), result.boxes.conf.tolist())
+      ])
+    return detections
+
+  def export(self):
+    from ultralytics import YOLO
+    if self.backend == 'pytorch':
+      return DrawingDetectorService.MODEL_PATHS['pytorch']
+    model = YOLO(DrawingDetectorService.MODEL_PATHS['pytorch'])
+    if self.backend == 'onnx':
+      return model.export(format='onnx', imgsz=DrawingDetectorService.IMAGE_SIZE, dynamic=True, simplify=True)
+    if self.backend == 'openvino':
+      return model.export(format='openvino', imgsz=DrawingDetectorService.IMAGE_SIZE, dynamic=True)
+    # int8 post training quantization calibrates on the training set
+    return model.export(
+      format='openvino',
+      imgsz=DrawingDetectorService.IMAGE_SIZE,
+      dynamic=True,
+      int8=True,
+      data=DrawingDetectorService.DATASET_CONFIG_PATH
+    )
@@ -0,0 +1,115 @@
+import fcntl
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+class ImageTensorCache:
+  # append only store of preprocessed images: one raw uint8 file of fixed size rows
+  # and an index with the md5_hash of every row, in row order
+  TENSORS_FILENAME = 'tensors.u8'
+  INDEX_FILENAME = 'index.txt'
+  LOCK_FILENAME = 'lock'
+
+  def __init__(self, directory, shape=(512, 512, 1)):
+    self.directory = directory
+    self.shape = tuple(shape)
+    self.row_size = int(np.prod(self.shape))
+    self.tensors_path = os.path.join(directory, ImageTensorCache.TENSORS_FILENAME)
+    self.index_path = os.path.join(directory, ImageTensorCache.INDEX_FILENAME)
+    self.lock_path = os.path.join(directory, ImageTensorCache.LOCK_FILENAME)
+    self.rows = {}
+    self.row_count = 0
+    self.index_offset = 0
+    self._array = None
+    os.makedirs(directory, exist_ok=True)
+    self.load()
+
+  @contextmanager
+  def lock(self):
+    # several processes (flag_drawings, the pipeline) can share a cache, so appends and the
+    # cleanup of an interrupted append happen under an exclusive lock
+    with open(self.lock_path, 'a') as f:
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+  def _read_index(self):
+    # picks up the index lines written since the last read, by this process or another one
+    if not os.path.exists(self.index_path):
+      return
+    with open(self.index_path, 'rb') as f:
+      f.seek(self.index_offset)
+      data = f.read()
+    # a line without its newline is left over from an interrupted append
+    data = data[:data.rfind(b'\n') + 1]
+    for line in data.decode().splitlines():
+      self.rows[line.strip()] = self.row_count
+      self.row_count += 1
+    self.index_offset += len(data)
+    self._array = None
+
+  def _discard_interrupted_append(self):
+    # rows are written before their index lines, so anything past the index is an interrupted append.
+    # Only called with the lock held
+    if not os.path.exists(self.tensors_path):
+      open(self.tensors_path, 'wb').close()
+    expected_size = self.row_count * self.row_size
+    if os.path.getsize(self.tensors_path) < expected_size:
+      raise ValueError("Tensor cache %s is missing rows listed in its index" % self.directory)
+    if os.path.getsize(self.tensors_path) > expected_size:
+      os.truncate(self.tensors_path, expected_size)
+    if os.path.exists(self.index_path) and os.path.getsize(self.index_path) > self.index_offset:
+      os.truncate(self.index_path, self.index_offset)
+
+  def load(self):
+    with self.lock():
+      self.rows = {}
+      self.row_count = 0
+      self.index_offset = 0
+      self._read_index()
+      self._discard_interrupted_append()
+
+  def refresh(self):
+    # makes rows appended by other processes visible to this one
+    with self.lock():
+      self._read_index()
+
+  def __len__(self):
+    return self.row_count
+
+  def __contains__(self, md5_hash):
+    return md5_hash in self.rows
+
+  def missing(self, md5_hashes):
+    return [md5_hash for md5_hash in dict.fromkeys(md5_hashes) if md5_hash not in self.rows]
+
+  def append(self, md5_hashes, tensors):
+    # tensors is a uint8 array of shape (len(md5_hashes),) + shape. Rows another process appended
+    # in the meantime are read first, so row numbers always match the index file
+    tensors = np.ascontiguousarray(tensors, dtype=np.uint8).reshape((len(md5_hashes),) + self.shape)
+    with self.lock():
+      self._read_index()
+      self._discard_interrupted_append()
+      new_rows = [i for i, md5_hash in enumerate(md5_hashes) if md5_hash not in self.rows]
+      if len(new_rows) == 0:
+        return
+      with open(self.tensors_path, 'ab') as f:
+        f.write(tensors[new_rows].tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+      with open(self.index_path, 'a') as f:
+        f.write(''.join(md5_hashes[i] + '\n' for i in new_rows))
+      self._read_index()
+
+  def array(self):
+    if self._array is None:
+      if self.row_count == 0:
+        return np.zeros((0,) + self.shape, dtype=np.uint8)
+      self._array = np.memmap(self.tensors_path, dtype=np.uint8, mode='r', shape=(self.row_count,) + self.shape)
+    return self._array
+
+  def row_indices(self, md5_hashes):
+    return np.array([self.rows[md5_hash] for md5_hash in md5_hashes], dtype=np.int64)
@@ -0,0 +1,56 @@
+from PIL import Image
+
+from app.config import settings
+
+class PytesseractOcrBackend:
+  # shells out to the tesseract binary, which reloads the model on every call
+  def image_to_data(self, image, psm):
+    import pytesseract
+    custom_config = "--oem 1 --psm %s" % psm
+    return pytesseract.image_to_data(Image.fromarray(image), output_type=pytesseract.Output.DICT, config=custom_config)
+
+class TesserocrOcrBackend:
+  # keeps one tesseract engine loaded in process for the lifetime of the worker
+  def __init__(self):
+    import tesserocr
+    self.tesserocr = tesserocr
+    self.api = tesserocr.PyTessBaseAPI(oem=tesserocr.OEM.LSTM_ONLY)
+
+  def image_to_data(self, image, psm):
+    # returns the word level subset of pytesseract's image_to_data dict
+    ocr_result = {'text': [], 'conf': [], 'left': [], 'top': [], 'width': [], 'height': []}
+    level = self.tesserocr.RIL.WORD
+    self.api.SetPageSegMode(psm)
+    self.api.SetImage(Image.fromarray(image))
+    self.api.Recognize()
+    iterator = self.api.GetIterator()
+    if iterator is None:
+      return ocr_result
+    for word in self.tesserocr.iterate_level(iterator, level):
+      text = word.GetUTF8Text(level)
+      bounding_box = word.BoundingBox(level)
+      if text is None or bounding_box is None:
+        continue
+      x1, y1, x2, y2 = bounding_box
+      ocr_result['text'].append(text)
+      ocr_result['conf'].append(word.Confidence(level))
+      ocr_result['left'].append(x1)
+      ocr_result['top'].append(y1)
+      ocr_result['width'].append(x2 - x1)
+      ocr_result['height'].append(y2 - y1)
+    return ocr_result
+
+OCR_BACKENDS = {
+  'pytesseract': PytesseractOcrBackend,
+  'tesserocr': TesserocrOcrBackend
+}
+
+# one engine per process, shared by every service instance in it
+loaded_ocr_backends = {}
+
+def get_ocr_backend(name=None):
+  if name is None:
+    name = settings.ocr_backend
+  if name not in loaded_ocr_backends:
+    loaded_ocr_backends[name] = OCR_BACKENDS[name]()
+  return loaded_ocr_backends[name]
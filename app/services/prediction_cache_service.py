@@ -0,0 +1,79 @@
+import datetime
+import hashlib
+import os
+import uuid
+
+from databases import Database
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+
+def hash_model_files(path):
+  # a model version is the digest of its weights, so retraining or re-exporting
+  # invalidates cached predictions without anyone having to bump a number
+  hasher = hashlib.sha256()
+  if os.path.isdir(path):
+    filenames = sorted(
+      os.path.join(root, filename)
+      for root, _, filenames in os.walk(path)
+      for filename in filenames
+    )
+  else:
+    filenames = [path]
+  for filename in filenames:
+    hasher.update(os.path.relpath(filename, path).encode('utf-8'))
+    with open(filename, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        hasher.update(chunk)
+  return hasher.hexdigest()
+
+class PredictionCacheService:
+  def __init__(self, db: Database, model_id, model_version, preprocessing_version):
+    self.db = db
+    self.model_id = model_id
+    self.model_version = model_version
+    self.preprocessing_version = preprocessing_version
+
+  async def get_predictions(self, md5_hashes):
+    if len(md5_hashes) == 0:
+      return {}
+    model_predictions = db.ModelPrediction.Meta.table
+    rows = await self.db.fetch_all(
+      sqlalchemy.select([model_predictions.c.md5_hash, model_predictions.c.prediction]).where(
+        sqlalchemy.and_(
+          model_predictions.c.md5_hash.in_(md5_hashes),
+          model_predictions.c.model_id == self.model_id,
+          model_predictions.c.model_version == self.model_version,
+          model_predictions.c.preprocessing_version == self.preprocessing_version
+        )
+      )
+    )
+    return {row['md5_hash']: row['prediction'] for row in rows}
+
+  async def store_predictions(self, predictions):
+    # predictions maps md5_hash -> json serializable prediction
+    if len(predictions) == 0:
+      return
+    now = datetime.datetime.utcnow()
+    insert_predictions = insert(db.ModelPrediction.Meta.table).values([
+      {
+        'id': uuid.uuid4(),
+        'created_at': now,
+        'md5_hash': md5_hash,
+        'model_id': self.model_id,
+        'model_version': self.model_version,
+        'preprocessing_version': self.preprocessing_version,
+        'prediction': predictions[md5_hash]
+      }
+      for md5_hash in sorted(predictions.keys())
+    ])
+    await self.db.execute(
+      insert_predictions.on_conflict_do_update(
+        index_elements=['md5_hash', 'model_id', 'model_version', 'preprocessing_version'],
+        set_={
+          'prediction': insert_predictions.excluded.prediction,
+          'updated_at': now
+        }
+      )
+    )
@@ -0,0 +1,203 @@
+import asyncio
+import datetime
+import os
+import socket
+import uuid
+
+from databases import Database
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.config import settings
+
+class TaskQueueService:
+  # one queue per pipeline stage on top of the pipeline_tasks table. Workers claim tasks with
+  # FOR UPDATE SKIP LOCKED, so any number of processes can drain a stage without coordinating,
+  # and a task whose worker died is picked up again once its lease runs out
+  def __init__(self, db: Database, stage, worker_id=None, lease_seconds=None, max_attempts=None, retry_delay_seconds=None):
+    self.db = db
+    self.stage = stage
+    self.worker_id = worker_id if worker_id is not None else '%s:%s' % (socket.gethostname(), os.getpid())
+    self.lease = datetime.timedelta(seconds=lease_seconds if lease_seconds is not None else settings.task_lease_seconds)
+    self.max_attempts = max_attempts if max_attempts is not None else settings.task_max_attempts
+    self.retry_delay_seconds = retry_delay_seconds if retry_delay_seconds is not None else settings.task_retry_delay_seconds
+
+  async def enqueue(self, subject_ids, batch_size=1000, retry_failed=False):
+    # subjects that are pending or running are left alone. Callers only enqueue subjects that still
+    # need the stage, so a finished task for one of them is reset and runs again. Failed tasks ran out
+    # of attempts (or killed their worker) and are only reset when retry_failed is asked for
+    subject_ids = sorted(set(subject_ids))
+    if len(subject_ids) == 0:
+      return
+    now = datetime.datetime.utcnow()
+    tasks = db.PipelineTask.Meta.table
+    resettable = [db.PipelineTaskStatus.DONE.value]
+    if retry_failed:
+      resettable.append(db.PipelineTaskStatus.FAILED.value)
+    for i in range(0, len(subject_ids), batch_size):
+      await self.db.execute(
+        insert(tasks).values([
+          {
+            'id': uuid.uuid4(),
+            'created_at': now,
+            'stage': self.stage,
+            'subject_id': subject_id,
+            'status': db.PipelineTaskStatus.PENDING.value,
+            'attempts': 0,
+            'available_at': now
+          }
+          for subject_id in subject_ids[i:i + batch_size]
+        ]).on_conflict_do_update(
+          index_elements=['stage', 'subject_id'],
+          set_={
+            'status': db.PipelineTaskStatus.PENDING.value,
+            'attempts': 0,
+            'available_at': now,
+            'lease_expires_at': None,
+            'worker_id': None,
+            'updated_at': now
+          },
+          where=tasks.c.status.in_(resettable)
+        )
+      )
+
+  async def expire_exhausted(self):
+    # a task whose lease ran out on its last attempt most likely kills the worker (oom, segfault),
+    # so it's failed rather than handed to the next worker
+    now = datetime.datetime.utcnow()
+    tasks = db.PipelineTask.Meta.table
+    await self.db.execute(
+      tasks.update()
+        .where(sqlalchemy.and_(
+          tasks.c.stage == self.stage,
+          tasks.c.status == db.PipelineTaskStatus.RUNNING.value,
+          tasks.c.lease_expires_at < now,
+          tasks.c.attempts >= self.max_attempts
+        ))
+        .values(
+          status=db.PipelineTaskStatus.FAILED.value,
+          lease_expires_at=None,
+          last_error='lease expired',
+          updated_at=now
+        )
+    )
+
+  async def claim(self, limit=1):
+    # returns a list of (task_id, subject_id), leased to this worker
+    await self.expire_exhausted()
+    now = datetime.datetime.utcnow()
+    tasks = db.PipelineTask.Meta.table
+    claimable = sqlalchemy.select([tasks.c.id]) \
+      .where(sqlalchemy.and_(
+        tasks.c.stage == self.stage,
+        sqlalchemy.or_(
+          sqlalchemy.and_(
+            tasks.c.status == db.PipelineTaskStatus.PENDING.value,
+            tasks.c.available_at <= now
+          ),
+          sqlalchemy.and_(
+            tasks.c.status == db.PipelineTaskStatus.RUNNING.value,
+            tasks.c.lease_expires_at < now
+          )
+        )
+      )) \
+      .order_by(tasks.c.available_at) \
+      .limit(limit) \
+      .with_for_update(skip_locked=True)
+    rows = await self.db.fetch_all(
+      tasks.update()
+        .where(tasks.c.id.in_(claimable))
+        .values(
+          status=db.PipelineTaskStatus.RUNNING.value,
+          attempts=tasks.c.attempts + 1,
+          lease_expires_at=now + self.lease,
+          worker_id=self.worker_id,
+          updated_at=now
+        )
+        .returning(tasks.c.id, tasks.c.subject_id)
+    )
+    return [(row['id'], row['subject_id']) for row in rows]
+
+  async def extend_lease(self, task_ids):
+    now = datetime.datetime.utcnow()
+    tasks = db.PipelineTask.Meta.table
+    await self.db.execute(
+      tasks.update()
+        .where(sqlalchemy.and_(tasks.c.id.in_(task_ids), tasks.c.worker_id == self.worker_id))
+        .values(lease_expires_at=now + self.lease, updated_at=now)
+    )
+
+  async def complete(self, task_ids):
+    if len(task_ids) == 0:
+      return
+    now = datetime.datetime.utcnow()
+    tasks = db.PipelineTask.Meta.table
+    await self.db.execute(
+      tasks.update()
+        .where(tasks.c.id.in_(task_ids))
+        .values(
+          status=db.PipelineTaskStatus.DONE.value,
+          lease_expires_at=None,
+          last_error=None,
+          updated_at=now
+        )
+    )
+
+  async def fail(self, task_id, error):
+    # retried with exponential backoff until max_attempts, then left failed for inspection
+    now = datetime.datetime.utcnow()
+    tasks = db.PipelineTask.Meta.table
+    row = await self.db.fetch_one(sqlalchemy.select([tasks.c.attempts]).where(tasks.c.id == task_id))
+    attempts = row['attempts'] if row is not None else self.max_attempts
+    if attempts >= self.max_attempts:
+      status = db.PipelineTaskStatus.FAILED.value
+      available_at = now
+    else:
+      status = db.PipelineTaskStatus.PENDING.value
+      available_at = now + datetime.timedelta(seconds=self.retry_delay_seconds * 2 ** (attempts - 1))
+    await self.db.execute(
+      tasks.update()
+        .where(tasks.c.id == task_id)
+        .values(
+          status=status,
+          available_at=available_at,
+          lease_expires_at=None,
+          last_error=str(error)[:10000],
+          updated_at=now
+        )
+    )
+
+  async def keep_leases(self, task_ids):
+    while True:
+      await asyncio.sleep(self.lease.total_seconds() / 3)
+      await self.extend_lease(task_ids)
+
+  async def work(self, handler, batch_size=1, concurrency=1, limit=None):
+    # runs `concurrency` loops that each claim batch_size tasks and await handler(subject_ids).
+    # The handler may return {subject_id: error} for the subjects that failed; the rest are completed.
+    # If it raises, the whole batch is failed. Returns once the stage has nothing claimable left
+    processed = 0
+
+    async def run():
+      nonlocal processed
+      while limit is None or processed < limit:
+        claimed = await self.claim(batch_size if limit is None else min(batch_size, limit - processed))
+        if len(claimed) == 0:
+          return
+        processed += len(claimed)
+        task_ids = {subject_id: task_id for task_id, subject_id in claimed}
+        heartbeat = asyncio.create_task(self.keep_leases(list(task_ids.values())))
+        try:
+          failures = await handler(list(task_ids.keys())) or {}
+        except Exception as e:
+          failures = {subject_id: repr(e) for subject_id in task_ids}
+        finally:
+          heartbeat.cancel()
+        for subject_id, error in failures.items():
+          print("%s failed on %s: %s" % (self.stage, subject_id, error))
+          await self.fail(task_ids[subject_id], error)
+        await self.complete([task_id for subject_id, task_id in task_ids.items() if subject_id not in failures])
+
+    await asyncio.gather(*[run() for _ in range(concurrency)])
+    return processed
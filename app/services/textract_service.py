@@ -3,14 +3,16 @@ import tempfile
 import json
 
 from databases import Database
-import boto3
 from PyPDF2 import PdfReader, PdfWriter
 
 from app import db
 from app.config import settings
+from app.storage import get_storage, resolve, textract_key
 
 class TextractService:
   def __init__(self, db: Database):
+    import boto3
+
     self.db = db
     self.textract_client = boto3.client(
       'textract',
@@ -33,7 +35,7 @@ class TextractService:
                                 .get_or_none(unique_image_id=unique_image.id)
     # then grab the page corresponding to the image
     outfile_name = None
-    input_filename = bc_bid_file_image.bc_bid_file_id.local_filename
+    input_filename = resolve(bc_bid_file_image.bc_bid_file_id.local_filename)
     print(input_filename)
     with open(input_filename, "rb") as infile, tempfile.NamedTemporaryFile(delete=False) as outfile:
       reader = PdfReader(infile)
@@ -61,9 +63,8 @@ class TextractService:
       ],
     )
     
-    textract_filename = f'{unique_image.local_filename}_textract.json'
-    with open(textract_filename, 'w') as fh:
-      json.dump(response, fh, indent=4)
+    textract_filename = textract_key(unique_image.md5_hash)
+    get_storage().write_bytes(textract_filename, json.dumps(response, indent=4).encode('utf-8'))
     unique_image.textract_filename = textract_filename
     await unique_image.update()
     print(unique_image.textract_filename)
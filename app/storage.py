@@ -0,0 +1,126 @@
+# app/storage.py
+import os
+import shutil
+
+from app.config import settings
+
+def sharded_key(namespace, content_hash, extension=''):
+  # two levels of hash prefix keep every directory down to a few hundred entries
+  return '%s/%s/%s/%s%s' % (namespace, content_hash[:2], content_hash[2:4], content_hash, extension)
+
+def unique_image_key(md5_hash):
+  return sharded_key('unique_images', md5_hash, '.png')
+
+def textract_key(md5_hash):
+  return sharded_key('textract', md5_hash, '.json')
+
+def bid_file_key(bid_file_id):
+  bid_file_id = str(bid_file_id)
+  return '%s/%s/%s/source_file' % ('bid_files', bid_file_id[:2], bid_file_id)
+
+def write_atomically(path, data):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = '%s.tmp' % path
+  with open(tmp_path, 'wb') as fh:
+    fh.write(data)
+  os.replace(tmp_path, path)
+
+class LocalStorage:
+  def __init__(self, root):
+    self.root = root
+
+  def local_path(self, key):
+    return os.path.join(self.root, key)
+
+  def staging_path(self, key):
+    # where a caller can write the file for key before committing it
+    path = self.local_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+  def commit(self, key):
+    pass
+
+  def exists(self, key):
+    return os.path.exists(self.local_path(key))
+
+  def write_bytes(self, key, data):
+    write_atomically(self.local_path(key), data)
+
+class S3Storage:
+  # works against aws or any s3 compatible server (minio, localstack) through endpoint_url.
+  # Files are materialized under cache_root on first read, since cv2, tensorflow and
+  # poppler all need a real path
+  def __init__(self, bucket, cache_root, endpoint_url=None):
+    import boto3
+
+    self.bucket = bucket
+    self.cache_root = cache_root
+    self.client = boto3.client(
+      's3',
+      endpoint_url=endpoint_url,
+      aws_access_key_id=settings.aws_access_key_id,
+      aws_secret_access_key=settings.aws_secret_access_key,
+      region_name=settings.aws_region
+    )
+
+  def local_path(self, key):
+    path = os.path.join(self.cache_root, key)
+    if not os.path.exists(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      tmp_path = '%s.tmp' % path
+      self.client.download_file(self.bucket, key, tmp_path)
+      os.replace(tmp_path, path)
+    return path
+
+  def staging_path(self, key):
+    path = os.path.join(self.cache_root, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+  def commit(self, key):
+    self.client.upload_file(os.path.join(self.cache_root, key), self.bucket, key)
+
+  def exists(self, key):
+    from botocore.exceptions import ClientError
+
+    try:
+      self.client.head_object(Bucket=self.bucket, Key=key)
+      return True
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+        return False
+      raise
+
+  def write_bytes(self, key, data):
+    self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+    # keep a local copy so the rest of the pipeline doesn't download what was just rendered
+    write_atomically(os.path.join(self.cache_root, key), data)
+
+loaded_storage = None
+
+def get_storage():
+  # one client per process, so pool workers each build their own
+  global loaded_storage
+  if loaded_storage is None:
+    if settings.storage_backend == 'local':
+      loaded_storage = LocalStorage(settings.storage_path)
+    elif settings.storage_backend == 's3':
+      loaded_storage = S3Storage(settings.storage_bucket, settings.storage_path, settings.storage_endpoint_url)
+    else:
+      raise ValueError("Unknown storage backend %s" % settings.storage_backend)
+  return loaded_storage
+
+def resolve(filename):
+  # rows written before the storage layer hold absolute paths, which are used as is
+  if filename is None or os.path.isabs(filename):
+    return filename
+  return get_storage().local_path(filename)
+
+def copy_to_storage(local_filename, key):
+  storage = get_storage()
+  staging_path = storage.staging_path(key)
+  if os.path.abspath(local_filename) != os.path.abspath(staging_path):
+    shutil.copyfile(local_filename, staging_path)
+  storage.commit(key)
+  return key